@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""Downloaded archives for packaged resources, shared between projects.
+
+Archives are kept at <url key>/archive.<type> under the archive directory,
+so they can be revalidated like any other cached file. Their members are
+extracted into trees named by the archive's sha256, and only when a build
+asks for them: a library that uses three files from a release zip only
+ever extracts those three. When an archive is replaced by a new download,
+the tree of the old one is removed.
+"""
+
+from glob import glob
+from hashlib import sha1, sha256
+from os import rename, getpid
+from os.path import join, dirname, isfile, normpath, relpath
+from shutil import copyfileobj, rmtree
+from tarfile import open as open_tar
+from zipfile import ZipFile
+
+from cache import CACHE_DIR
+from utilities import (mkdirp, read_file, replace_file,
+	UnknownArchiveException)
+
+ARCHIVE_DIR = join(CACHE_DIR, ".archives")
+TREES = ".trees"
+CHUNK = 64 * 1024
+
+def archive_path(url, package_type, archive_dir=ARCHIVE_DIR):
+	key = sha1(url).hexdigest()[:16]
+	return join(archive_dir, key, "archive." + package_type)
+
+def _digest(fp):
+	h = sha256()
+	with open(fp, "rb") as f:
+		for chunk in iter(lambda: f.read(CHUNK), ""):
+			h.update(chunk)
+	return h.hexdigest()
+
+class Archive(object):
+	"""An archive and the tree its members are extracted into on demand."""
+
+	def __init__(self, path, package_type, archive_dir=ARCHIVE_DIR):
+		if not package_type in ["zip", "tar"]:
+			raise UnknownArchiveException(package_type)
+		self.path = path
+		self.package_type = package_type
+		digest = _digest(path)
+		self.tree = join(archive_dir, TREES, digest)
+		self.members = None
+		self._replace_tree(archive_dir, digest)
+
+	def _replace_tree(self, archive_dir, digest):
+		"""Removes the tree of the archive this one replaced at its path."""
+		record = self.path + ".tree"
+		old = read_file(record).strip() if isfile(record) else None
+		if old == digest:
+			return
+		if old:
+			# Another url may have downloaded the very same archive
+			others = [fp for fp in glob(join(archive_dir, "*", "*.tree"))
+					if fp != record and read_file(fp).strip() == old]
+			if not len(others):
+				rmtree(join(archive_dir, TREES, old), True)
+		replace_file(record, digest)
+
+	def _open(self):
+		if self.package_type == "zip":
+			return ZipFile(self.path, "r")
+		return open_tar(self.path, "r")
+
+	def _list(self, archive):
+		"""Maps each safe, normalised file name to its member."""
+		if self.package_type == "zip":
+			entries = [(i.filename, i) for i in archive.infolist()
+					if not i.filename.endswith("/")]
+		else:
+			entries = [(m.name, m) for m in archive.getmembers() if m.isfile()]
+		members = {}
+		for name, member in entries:
+			name = normpath(name)
+			# Never write outside the tree
+			if name.startswith("..") or name.startswith("/"):
+				continue
+			members[name] = member
+		return members
+
+	def _read(self, archive, member):
+		if self.package_type == "zip":
+			return archive.open(member)
+		return archive.extractfile(member)
+
+	def contains(self, path):
+		return normpath(path).startswith(self.tree + "/")
+
+	def extract(self, prefix=""):
+		"""Extracts the file or directory at prefix, returning its path.
+
+		Members already in the tree are left alone, so trees can be
+		shared by any number of projects and runs.
+		"""
+		prefix = normpath(prefix) if prefix else ""
+		archive = self._open()
+		try:
+			if self.members is None:
+				self.members = self._list(archive)
+			for name, member in self.members.items():
+				if prefix and name != prefix and \
+						not name.startswith(prefix + "/"):
+					continue
+				dest = join(self.tree, name)
+				if isfile(dest):
+					continue
+				mkdirp(dirname(dest))
+				tmp = "{0}.{1}.tmp".format(dest, getpid())
+				src = self._read(archive, member)
+				with open(tmp, "wb") as out:
+					copyfileobj(src, out)
+				rename(tmp, dest)
+		finally:
+			archive.close()
+		return join(self.tree, prefix)
+
+	def extract_path(self, path):
+		"""Extracts whatever is at path, if it lies in this tree."""
+		if self.contains(path):
+			self.extract(relpath(normpath(path), self.tree))
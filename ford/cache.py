@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""Content-addressed storage for files kept in the Ford cache.
+
+Cached files live at <lib>/<resource>/<file> under the cache directory.
+Each one is a hardlink to a sha256-named blob, and each library keeps an
+index of the blob and the HTTP validators behind every file it holds.
+
+Blobs are read-only and shared, so projects never get a hardlink to one:
+files placed in a project are reflinked where the filesystem can, and
+copied otherwise, and stay the project's own to edit.
+"""
+
+from fcntl import ioctl
+from hashlib import sha256
+from json import dumps, loads
+from os import link, rename, chmod, getpid
+from os.path import join, dirname, basename, isfile, samefile, expanduser
+from shutil import copyfile, copyfileobj
+from stat import S_IRUSR, S_IRGRP, S_IROTH
+
+from utilities import read_file, write_file, mkdirp
+
+CACHE_DIR = expanduser("~/.ford/cache")
+BLOB_DIR = join(CACHE_DIR, ".blobs")
+INDEX = ".index.json"
+READ_ONLY = S_IRUSR | S_IRGRP | S_IROTH
+CHUNK = 64 * 1024
+# Linux's ioctl for sharing one file's extents with another
+FICLONE = 0x40049409
+
+def content_hash(data):
+	return sha256(data).hexdigest()
+
+def file_hash(fp):
+	"""Hashes a file a chunk at a time, however big it is."""
+	h = sha256()
+	with open(fp, "rb") as f:
+		for chunk in iter(lambda: f.read(CHUNK), ""):
+			h.update(chunk)
+	return h.hexdigest()
+
+#------------------------------
+# Library index
+#------------------------------
+
+def _index_location(fp):
+	resource_dir = dirname(fp)
+	key = "/".join([basename(resource_dir), basename(fp)])
+	return join(dirname(resource_dir), INDEX), key
+
+def _read_index(path):
+	if not isfile(path):
+		return {}
+	try:
+		return loads(read_file(path))
+	except ValueError:
+		return {}
+
+def _entry(fp):
+	path, key = _index_location(fp)
+	return _read_index(path).get(key, {})
+
+def _update_entry(fp, values):
+	path, key = _index_location(fp)
+	index = _read_index(path)
+	index.setdefault(key, {}).update(values)
+	write_file(path, dumps(index))
+
+#------------------------------
+# Validators
+#------------------------------
+
+def get_validators(fp):
+	"""Returns the stored validators for a cached file, if it is intact."""
+	if not isfile(fp):
+		return None
+	v = _entry(fp)
+	if v.get("sha256") != file_hash(fp):
+		return None
+	return v
+
+def conditional_headers(fp):
+	"""Builds the request headers to revalidate a cached file."""
+	v = get_validators(fp)
+	if v is None:
+		return None
+	headers = {}
+	if v.get("etag"):
+		headers["If-None-Match"] = v["etag"]
+	if v.get("last_modified"):
+		headers["If-Modified-Since"] = v["last_modified"]
+	if not len(headers):
+		return None
+	return headers
+
+def save_validators(fp, headers, digest):
+	"""Records the ETag, Last-Modified and sha256 of a cached file."""
+	_update_entry(fp, {
+		"etag": headers.get("etag"),
+		"last_modified": headers.get("last-modified"),
+		"sha256": digest
+	})
+
+#------------------------------
+# Blobs
+#------------------------------
+
+def blob_path(digest):
+	return join(BLOB_DIR, digest[:2], digest)
+
+def _link_or_copy(src, dest):
+	# Renaming a link over the same file leaves the link behind
+	if isfile(dest) and samefile(src, dest):
+		return
+	tmp = "{0}.{1}.tmp".format(dest, getpid())
+	try:
+		link(src, tmp)
+	except OSError:
+		copyfile(src, tmp)
+	rename(tmp, dest)
+
+def _clone(src, dest):
+	"""Copies src over dest, sharing its blocks when the filesystem can."""
+	tmp = "{0}.{1}.tmp".format(dest, getpid())
+	with open(src, "rb") as fsrc:
+		with open(tmp, "wb") as fdest:
+			try:
+				ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+			except (IOError, OSError):
+				copyfileobj(fsrc, fdest, CHUNK)
+	rename(tmp, dest)
+
+def store_blob(fp, digest=None):
+	"""Copies any file into the blob store, returning its digest."""
+	if digest is None:
+		digest = file_hash(fp)
+	blob = blob_path(digest)
+	if not isfile(blob):
+		mkdirp(dirname(blob))
+		tmp = "{0}.{1}.tmp".format(blob, getpid())
+		copyfile(fp, tmp)
+		# Blobs are shared between projects and must never be edited in place
+		chmod(tmp, READ_ONLY)
+		rename(tmp, blob)
+	return digest
+
+def store(fp, digest=None):
+	"""Moves a cached file into the blob store, leaving a hardlink behind."""
+	digest = store_blob(fp, digest)
+	blob = blob_path(digest)
+	if not samefile(fp, blob):
+		_link_or_copy(blob, fp)
+	_update_entry(fp, {"sha256": digest})
+	return digest
+
+def has_blob(digest):
+	return isfile(blob_path(digest))
+
+def restore_blob(digest, dest):
+	"""Places a writable copy of a stored blob at dest."""
+	mkdirp(dirname(dest))
+	_clone(blob_path(digest), dest)
+
+def materialize(fp, dest):
+	"""Places a writable copy of a cached file at dest."""
+	digest = _entry(fp).get("sha256")
+	if digest is None or not isfile(blob_path(digest)) or \
+			not samefile(fp, blob_path(digest)):
+		digest = store(fp)
+	_clone(blob_path(digest), dest)
+	return digest
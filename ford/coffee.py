@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""CoffeeScript compilation with a persistent cache of compiled output.
+
+Sources are compiled in batches: one javascript runtime evaluates the
+compiler once and compiles every pending source, instead of booting the
+compiler again for each file.
+"""
+
+from hashlib import sha256
+from multiprocessing import cpu_count
+from os.path import join, dirname, isfile
+from re import search
+from threading import Thread, local
+
+import coffeescript
+import execjs
+
+from utilities import read_file, replace_file, mkdirp
+
+COFFEE_SCRIPT_JS = join(dirname(coffeescript.__file__), 'coffee-script.js')
+
+BATCH_JS = """
+function fordCompileBatch(sources) {
+	var out = [];
+	for (var i = 0; i < sources.length; i++) {
+		try {
+			out.push([CoffeeScript.compile(sources[i]), null]);
+		} catch (e) {
+			out.push([null, String(e)]);
+		}
+	}
+	return out;
+}
+"""
+
+compiler_id = None
+def compiler_version():
+	"""Identifies the bundled compiler by its version banner, or its hash."""
+	global compiler_id
+	if compiler_id is None:
+		src = read_file(COFFEE_SCRIPT_JS)
+		m = search(r"CoffeeScript Compiler v([\w.\-]+)", src[:1024])
+		if m is not None:
+			compiler_id = m.group(1)
+		else:
+			compiler_id = sha256(src).hexdigest()
+	return compiler_id
+
+# execjs contexts are not safe to share, so each thread evaluates its own
+batch_context = local()
+def _context():
+	context = getattr(batch_context, "context", None)
+	if context is None:
+		context = execjs.compile(read_file(COFFEE_SCRIPT_JS) + BATCH_JS)
+		batch_context.context = context
+	return context
+
+def _cache_path(cache_dir, src):
+	data = src
+	if isinstance(data, unicode):
+		data = data.encode("utf-8")
+	key = sha256("\0".join([compiler_version(), data])).hexdigest()
+	return join(cache_dir, key[:2], key + ".js")
+
+def _compile_chunk(sources, results, indexes):
+	try:
+		out = _context().call("fordCompileBatch",
+				[sources[i] for i in indexes])
+	except execjs.Error as e:
+		if len(indexes) == 1:
+			out = [(None, str(e))]
+		else:
+			# Retry one by one so only the source that broke the runtime fails
+			batch_context.context = None
+			for i in indexes:
+				_compile_chunk(sources, results, [i])
+			return
+	for i, (js, err) in zip(indexes, out):
+		if isinstance(js, unicode):
+			js = js.encode("utf-8")
+		results[i] = (js, err)
+
+def compile_batch(sources, cache_dir=None, jobs=None):
+	"""Compiles a list of sources, returning (js, error) pairs in order.
+
+	Cached sources are read back from cache_dir; the rest are split over
+	up to jobs runtimes, one per core by default.
+	"""
+	results = [None] * len(sources)
+	pending = []
+	for i, src in enumerate(sources):
+		if cache_dir is not None:
+			fp = _cache_path(cache_dir, src)
+			if isfile(fp):
+				results[i] = (read_file(fp), None)
+				continue
+		pending.append(i)
+
+	if not len(pending):
+		return results
+
+	if jobs is None:
+		jobs = cpu_count()
+	jobs = max(1, min(jobs, len(pending)))
+	chunks = [pending[i::jobs] for i in range(jobs)]
+	if jobs == 1:
+		_compile_chunk(sources, results, pending)
+	else:
+		threads = [Thread(target=_compile_chunk, args=[sources, results, c])
+				for c in chunks]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+
+	if cache_dir is not None:
+		for i in pending:
+			js, err = results[i]
+			if err is None:
+				fp = _cache_path(cache_dir, sources[i])
+				mkdirp(dirname(fp))
+				replace_file(fp, js)
+
+	return results
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+"""Compiler backends that merge and minify Ford's javascript and css."""
+
+from base64 import b64encode
+from hashlib import sha256
+from mimetypes import guess_type
+from os.path import join, dirname, isfile, relpath, getsize, normpath
+from re import compile as regex, DOTALL
+
+from utilities import read_file, write_file, replace_file, call, mkdirp
+
+DEFAULT_COMPILER = "native"
+# Bump whenever jsmin or cssmin change their output
+MINIFIER_VERSION = "1"
+# Images larger than this stay files instead of data uris
+EMBED_MAX = 32 * 1024
+
+DEPENDS = regex(r"@depends\s+(\S+)")
+IMPORT = regex(r"@import\s+url\(\s*['\"]?([^'\")]+)['\"]?\s*\)\s*;?")
+CSS_URL = regex(r"url\(\s*(['\"]?)([^'\")]+)\1\s*\)")
+CSS_TOKENS = regex(r"(\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*')|(/\*.*?\*/)",
+	DOTALL)
+CSS_SPACE = regex(r"\s+")
+CSS_PUNCT = regex(r"\s*([{};,>])\s*")
+CSS_COLON = regex(r":\s+")
+
+#------------------------------
+# Minifiers
+#------------------------------
+
+def _alphanum(c):
+	return c is not None and (c.isalnum() or c in "_$\\" or ord(c) > 126)
+
+def jsmin(js):
+	"""Minifies javascript using Douglas Crockford's jsmin algorithm."""
+	src = js.replace("\r\n", "\n").replace("\r", "\n")
+	state = {"i": 0, "lookahead": None}
+	out = []
+
+	def get():
+		c = state["lookahead"]
+		state["lookahead"] = None
+		if c is None:
+			if state["i"] >= len(src):
+				return None
+			c = src[state["i"]]
+			state["i"] += 1
+		if c >= " " or c == "\n":
+			return c
+		return " "
+
+	def peek():
+		state["lookahead"] = get()
+		return state["lookahead"]
+
+	def next():
+		c = get()
+		if c == "/":
+			p = peek()
+			if p == "/":
+				while True:
+					c = get()
+					if c is None or c == "\n":
+						return c
+			elif p == "*":
+				get()
+				while True:
+					c = get()
+					if c is None:
+						raise ValueError("Unterminated comment")
+					if c == "*" and peek() == "/":
+						get()
+						return " "
+		return c
+
+	def next_visible():
+		# The next character after any spaces, without consuming it
+		i = state["i"]
+		while i < len(src) and src[i] == " ":
+			i += 1
+		if i < len(src):
+			return src[i]
+		return None
+
+	ab = {"a": "\n", "b": None}
+
+	def action(d):
+		if d <= 1:
+			out.append(ab["a"])
+		if d <= 2:
+			ab["a"] = ab["b"]
+			if ab["a"] in ["'", '"', "`"]:
+				while True:
+					out.append(ab["a"])
+					ab["a"] = get()
+					if ab["a"] == ab["b"]:
+						break
+					if ab["a"] == "\\":
+						out.append(ab["a"])
+						ab["a"] = get()
+					if ab["a"] is None:
+						raise ValueError("Unterminated string literal")
+		if d <= 3:
+			ab["b"] = next()
+			if ab["b"] == "/" and ab["a"] is not None and \
+					ab["a"] in "(,=:[!&|?+-~*/{}\n;":
+				out.append(ab["a"])
+				if ab["a"] in "/*":
+					out.append(" ")
+				out.append(ab["b"])
+				while True:
+					ab["a"] = get()
+					if ab["a"] == "[":
+						while True:
+							out.append(ab["a"])
+							ab["a"] = get()
+							if ab["a"] == "]":
+								break
+							if ab["a"] == "\\":
+								out.append(ab["a"])
+								ab["a"] = get()
+							if ab["a"] is None:
+								raise ValueError("Unterminated set in regex")
+					elif ab["a"] == "/":
+						break
+					elif ab["a"] == "\\":
+						out.append(ab["a"])
+						ab["a"] = get()
+					if ab["a"] is None:
+						raise ValueError("Unterminated regex literal")
+					out.append(ab["a"])
+				ab["b"] = next()
+
+	if src[:3] == "\xef\xbb\xbf":
+		state["i"] = 3
+
+	action(3)
+	while ab["a"] is not None:
+		a, b = ab["a"], ab["b"]
+		if a == " ":
+			action(1 if _alphanum(b) else 2)
+		elif a == "\n":
+			if b is not None and b in "{[(+-!~":
+				action(1)
+			elif b == " ":
+				action(3)
+			else:
+				action(1 if _alphanum(b) else 2)
+		elif b == " ":
+			# Keep the space in "a + +b" and "a - -b"
+			if a in "+-" and next_visible() == a:
+				action(1)
+				out.append(" ")
+			else:
+				action(1 if _alphanum(a) else 3)
+		elif b == "\n":
+			if a in "}])+-\"'`":
+				action(1)
+			else:
+				action(1 if _alphanum(a) else 3)
+		else:
+			action(1)
+
+	return "".join(out).strip()
+
+def cssmin(css):
+	"""Strips comments and redundant whitespace from a stylesheet."""
+	parts = []
+	last = 0
+	for m in CSS_TOKENS.finditer(css):
+		parts.append((css[last:m.start()], False))
+		if m.group(1) is not None:
+			parts.append((m.group(1), True))
+		last = m.end()
+	parts.append((css[last:], False))
+
+	out = []
+	for text, is_string in parts:
+		if not is_string:
+			text = CSS_SPACE.sub(" ", text)
+			text = CSS_PUNCT.sub(r"\1", text)
+			text = CSS_COLON.sub(":", text)
+		out.append(text)
+	return "".join(out).replace(";}", "}").strip()
+
+class MinifyCache(object):
+	"""Keeps minified output on disk, keyed by the source and minifier."""
+
+	def __init__(self, path):
+		self.path = path
+		self.hits = 0
+		self.misses = 0
+
+	def minify(self, ftype, data, minifier):
+		key = sha256("|".join([ftype, MINIFIER_VERSION, data])).hexdigest()
+		fp = join(self.path, key[:2], key)
+		if isfile(fp):
+			self.hits += 1
+			return read_file(fp)
+		self.misses += 1
+		out = minifier(data)
+		mkdirp(dirname(fp))
+		replace_file(fp, out)
+		return out
+
+#------------------------------
+# Backends
+#------------------------------
+
+class Compiler(object):
+	"""Merges a @depends javascript or @import css file into one output.
+
+	Subclasses implement merge(ftype, src_file, out_file, document_root,
+	minify), which returns a tuple of whether it succeeded and its log.
+	Every backend takes the minify cache directory, used or not.
+	"""
+
+	name = None
+
+	def __init__(self, cache_dir=None):
+		self.cache_dir = cache_dir
+
+	def available(self):
+		return True
+
+class JuicerCompiler(Compiler):
+	"""Shells out to the juicer ruby gem."""
+
+	name = "juicer"
+
+	def available(self):
+		return call(["which", "juicer"]) == 0
+
+	def merge(self, ftype, src_file, out_file, document_root, minify=True):
+		cmd = ["juicer", "merge", "--force", "--document-root",
+				"'{0}'".format(document_root)]
+		if ftype == "js":
+			cmd += ["--skip-verification"]
+			if not minify:
+				cmd += ['--minifyer ""']
+		elif ftype == "css":
+			cmd += ["--force-image-embed", "--embed-images", "data_uri"]
+		cmd += ["'{0}'".format(src_file)]
+		resp = call(cmd, sout=True)
+
+		# Juicer doesn't fail on failure; test for such cases
+		is_error = "[ERROR]" in resp or "Errno::ENOENT" in resp
+		return not is_error, resp
+
+def _remote(url):
+	return "://" in url or url[:2] == "//"
+
+class NativeCompiler(Compiler):
+	"""Merges and minifies in-process, without any external tools.
+
+	Each part is minified on its own, so with a cache directory unchanged
+	parts are read back from the cache instead of being minified again.
+	"""
+
+	name = "native"
+
+	def __init__(self, cache_dir=None):
+		super(NativeCompiler, self).__init__(cache_dir)
+		self.cache = None
+		if cache_dir is not None:
+			self.cache = MinifyCache(cache_dir)
+
+	def _minify(self, ftype, data, minifier):
+		if self.cache is None:
+			return minifier(data)
+		return self.cache.minify(ftype, data, minifier)
+
+	def _part_path(self, document_root, src_file, part):
+		if part[0] == "/":
+			return normpath(join(document_root, part[1:]))
+		return normpath(join(dirname(src_file), part))
+
+	def _embed_urls(self, css, part, out_file):
+		def embed(m):
+			url = m.group(2).strip()
+			if url[:5] == "data:" or _remote(url):
+				return m.group(0)
+			fp = join(dirname(part), url.split("?")[0].split("#")[0])
+			# Like juicer, only images are embedded; fonts and the like
+			# are left as files, and so are images too big to inline
+			mime = guess_type(fp)[0]
+			if isfile(fp) and mime is not None and \
+					mime.startswith("image/") and getsize(fp) <= EMBED_MAX:
+				data = b64encode(read_file(fp))
+				return "url(data:{0};base64,{1})".format(mime, data)
+			# Keep urls we can't embed pointing at the same file
+			return "url({0})".format(relpath(fp, dirname(out_file)))
+		return CSS_URL.sub(embed, css)
+
+	def _expand(self, ftype, document_root, src_file, parts, seen, log):
+		"""Lists the files parts name, each after those it names itself.
+
+		Nested @depends and @import lines are followed as juicer follows
+		them; a file already listed is not listed again.
+		"""
+		found = DEPENDS if ftype == "js" else IMPORT
+		files = []
+		for p in parts:
+			# Remote imports are left for the browser
+			if _remote(p):
+				continue
+			fp = self._part_path(document_root, src_file, p)
+			if fp in seen:
+				continue
+			seen.add(fp)
+			if not isfile(fp):
+				log.append("[ERROR] Missing file {0}".format(fp))
+				return None
+			nested = self._expand(ftype, document_root, fp,
+					found.findall(read_file(fp)), seen, log)
+			if nested is None:
+				return None
+			files += nested + [fp]
+		return files
+
+	def merge(self, ftype, src_file, out_file, document_root, minify=True):
+		src = read_file(src_file)
+		if ftype == "js":
+			parts = DEPENDS.findall(src)
+		else:
+			parts = IMPORT.findall(src)
+
+		log = []
+		files = self._expand(ftype, document_root, src_file, parts,
+				set([normpath(src_file)]), log)
+		if files is None:
+			return False, "\n".join(log)
+		content = []
+		remote = []
+
+		def hoist(m):
+			# Local imports are merged in ahead of their importer; remote
+			# ones must stay @imports, and those are only valid up front
+			if _remote(m.group(1)) and m.group(0).strip() not in remote:
+				remote.append(m.group(0).strip())
+			return ""
+
+		for fp in files:
+			data = read_file(fp)
+			try:
+				if ftype == "js":
+					if minify:
+						data = self._minify(ftype, data, jsmin)
+				else:
+					data = IMPORT.sub(hoist, data)
+					data = self._embed_urls(data, fp, out_file)
+					data = self._minify(ftype, data, cssmin)
+			except ValueError as e:
+				log.append("[ERROR] {0}: {1}".format(fp, e))
+				return False, "\n".join(log)
+			log.append("Merged {0}".format(fp))
+			content.append(data)
+
+		if self.cache is not None:
+			log.append("Minify cache: {0} hits, {1} misses".format(
+					self.cache.hits, self.cache.misses))
+		write_file(out_file, "\n".join(remote + content) + "\n")
+		return True, "\n".join(log)
+
+COMPILERS = {
+	JuicerCompiler.name: JuicerCompiler,
+	NativeCompiler.name: NativeCompiler
+}
+
+def get_compiler(name=None, cache_dir=None):
+	if name is None:
+		name = DEFAULT_COMPILER
+	if not name in COMPILERS:
+		raise KeyError(name)
+	return COMPILERS[name](cache_dir)
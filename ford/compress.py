@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""Precompressed .gz and .br siblings of built files, and picking them.
+
+The build writes the variants once; the server then only has to choose
+which file to send for a request's Accept-Encoding.
+"""
+
+from gzip import GzipFile
+from os import walk, remove, rename, getpid
+from os.path import join, isfile, splitext, getsize, getmtime
+from shutil import copyfileobj
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+TEXT_TYPES = [".html", ".htm", ".js", ".css", ".json", ".svg", ".txt",
+		".xml", ".map", ".ico", ".eot", ".ttf", ".otf"]
+# Files this small do not get smaller enough to be worth a variant
+MIN_SIZE = 256
+
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+# Preferred first
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+def compressible(fp):
+	return splitext(fp)[1].lower() in TEXT_TYPES
+
+def settings(option):
+	"""Reads the manifest's compress option: a bool, a level or a dict."""
+	if option is None or option is False:
+		return None
+	gzip_level, brotli_quality = GZIP_LEVEL, BROTLI_QUALITY
+	if isinstance(option, dict):
+		gzip_level = int(option.get("level", gzip_level))
+		brotli_quality = option.get("brotli", brotli_quality)
+		if brotli_quality is not False:
+			brotli_quality = int(brotli_quality)
+	elif option is not True:
+		gzip_level = int(option)
+	if brotli is None:
+		brotli_quality = False
+	return gzip_level, brotli_quality
+
+def _current(src, variant):
+	return isfile(variant) and getmtime(variant) >= getmtime(src)
+
+def _write(variant, writer, size):
+	"""Moves a finished variant into place, unless it saves nothing."""
+	tmp = "{0}.{1}.tmp".format(variant, getpid())
+	writer(tmp)
+	if getsize(tmp) >= size:
+		remove(tmp)
+		if isfile(variant):
+			remove(variant)
+		return False
+	rename(tmp, variant)
+	return True
+
+def compress_file(fp, gzip_level=GZIP_LEVEL, brotli_quality=BROTLI_QUALITY):
+	"""Writes fp.gz and fp.br when missing or older than fp.
+
+	Returns the number of variants written.
+	"""
+	size = getsize(fp)
+	if size < MIN_SIZE:
+		return 0
+	written = 0
+
+	variant = fp + ".gz"
+	if not _current(fp, variant):
+		def gz(tmp):
+			with open(fp, "rb") as src, open(tmp, "wb") as raw:
+				# No name or mtime, so identical builds are byte for byte equal
+				with GzipFile("", "wb", gzip_level, raw, mtime=0) as out:
+					copyfileobj(src, out)
+		written += _write(variant, gz, size)
+
+	variant = fp + ".br"
+	if brotli_quality is not False and not _current(fp, variant):
+		def br(tmp):
+			with open(fp, "rb") as src:
+				data = brotli.compress(src.read(), quality=brotli_quality)
+			with open(tmp, "wb") as out:
+				out.write(data)
+		written += _write(variant, br, size)
+	return written
+
+def compress_tree(root, gzip_level=GZIP_LEVEL, brotli_quality=BROTLI_QUALITY):
+	"""Compresses every text file under root, returning variants written."""
+	written = 0
+	for path, dirs, files in walk(root):
+		for f in files:
+			fp = join(path, f)
+			if compressible(fp):
+				written += compress_file(fp, gzip_level, brotli_quality)
+	return written
+
+def accepted(accept_encoding):
+	"""Lists the codings an Accept-Encoding header allows."""
+	codings = set()
+	for part in (accept_encoding or "").split(","):
+		bits = part.strip().split(";")
+		coding = bits[0].strip().lower()
+		q = 1.0
+		for b in bits[1:]:
+			b = b.strip()
+			if b.startswith("q="):
+				try:
+					q = float(b[2:])
+				except ValueError:
+					q = 0
+		if coding and q > 0:
+			codings.add(coding)
+	return codings
+
+def negotiate(fp, accept_encoding):
+	"""Returns the file to send for fp and its Content-Encoding, if any."""
+	if not compressible(fp):
+		return fp, None
+	codings = accepted(accept_encoding)
+	for coding, ext in ENCODINGS:
+		if coding in codings or "*" in codings:
+			variant = fp + ext
+			# A variant older than its file is left over from an old build
+			if isfile(variant) and _current(fp, variant):
+				return variant, coding
+	return fp, None
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Rewrites the url() references of library stylesheets into images/.
+
+Stylesheets are scanned once, token by token, so comments and strings are
+left alone and every url() is rewritten exactly once, however often the
+same reference appears.
+"""
+
+from json import dumps, loads
+from os.path import isfile, dirname
+from re import compile as regex, DOTALL, IGNORECASE, VERBOSE
+
+from utilities import read_file, replace_file, mkdirp
+
+CSS_TOKENS = regex(r"""
+	(/\*.*?\*/)
+	| url\(\s*(?: "([^"]*)" | '([^']*)' | ([^)"'\s]*) )\s*\)
+	| ("(?:[^"\\]|\\.)*" | '(?:[^'\\]|\\.)*')
+""", DOTALL | IGNORECASE | VERBOSE)
+
+def map_urls(css, fn):
+	"""Replaces each url() in css with fn(url), or leaves it if that is None.
+
+	data: URIs are always left as they are.
+	"""
+	def token(m):
+		if m.group(1) is not None or m.group(5) is not None:
+			return m.group(0)
+		u = [g for g in m.group(2, 3, 4) if g is not None][0]
+		if u == "" or u[0:5] == "data:":
+			return m.group(0)
+		u = fn(u)
+		if u is None:
+			return m.group(0)
+		return "url({0})".format(u)
+
+	return CSS_TOKENS.sub(token, css)
+
+def rewrite_urls(css, fixes=None):
+	"""Points every url() in css at images/, replacing each of fixes.
+
+	fixes are the library's own image paths (cssImageFix); they are only
+	replaced inside url(), where they become "images".
+	"""
+	fixes = fixes or []
+
+	def image(u):
+		for fx in fixes:
+			u = u.replace(fx, "images")
+		if "images/" not in u:
+			u = "images/{0}".format(u)
+		return u
+
+	return map_urls(css, image)
+
+class RewriteLog(object):
+	"""Remembers the hash of each stylesheet before and after its rewrite."""
+
+	def __init__(self, path):
+		self.path = path
+		self.entries = {}
+		if isfile(path):
+			try:
+				self.entries = loads(read_file(path))
+			except ValueError:
+				pass
+
+	def get(self, fp, fixes):
+		entry = self.entries.get(fp)
+		if entry is None or entry["fixes"] != fixes:
+			return None
+		return entry
+
+	def set(self, fp, fixes, before, after):
+		self.entries[fp] = {"fixes": fixes, "in": before, "out": after}
+		mkdirp(dirname(self.path))
+		replace_file(self.path, dumps(self.entries))
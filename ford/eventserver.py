@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+"""An event loop server that hosts every project from one process.
+
+One thread multiplexes all connections, HTTP and HTTPS alike, with epoll
+(or select where there is none). Requests are answered by the same
+handler as the threaded servers, run on a fixed pool of workers that
+also read large files a chunk at a time, so idle keep-alive clients and
+slow readers cost a socket each instead of a thread each.
+"""
+
+import errno, fcntl, os, select, socket
+from Queue import Queue, Empty
+from StringIO import StringIO
+from sys import exit
+from threading import Thread
+from time import time
+
+from server import FordHTTPRequestHandler, FileBody
+
+try:
+	import ssl
+except ImportError:
+	ssl = None
+
+MAX_CONNECTIONS = 1024
+KEEPALIVE_TIMEOUT = 15
+WORKERS = 8
+# A request line and headers larger than this are refused
+MAX_HEADER = 64 * 1024
+# Bytes read from a file per worker job, and per recv and send
+READ_CHUNK = 256 * 1024
+RECV_CHUNK = 64 * 1024
+SEND_CHUNK = 64 * 1024
+
+READ, WRITE = 1, 2
+
+BUSY = ("HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n"
+		"Connection: close\r\n\r\n")
+TOO_LARGE = ("HTTP/1.1 431 Request Header Fields Too Large\r\n"
+		"Content-Length: 0\r\nConnection: close\r\n\r\n")
+
+#------------------------------
+# Polling
+#------------------------------
+
+class EpollPoller(object):
+	def __init__(self):
+		self.ep = select.epoll()
+
+	def _mask(self, events):
+		mask = 0
+		if events & READ:
+			mask |= select.EPOLLIN
+		if events & WRITE:
+			mask |= select.EPOLLOUT
+		return mask
+
+	def register(self, fd, events):
+		self.ep.register(fd, self._mask(events))
+
+	def modify(self, fd, events):
+		self.ep.modify(fd, self._mask(events))
+
+	def unregister(self, fd):
+		self.ep.unregister(fd)
+
+	def poll(self, timeout):
+		out = []
+		for fd, mask in self.ep.poll(timeout):
+			events = 0
+			# Errors and hangups are seen by the next recv or send
+			if mask & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+				events |= READ
+			if mask & select.EPOLLOUT:
+				events |= WRITE
+			out.append((fd, events))
+		return out
+
+class SelectPoller(object):
+	def __init__(self):
+		self.fds = {}
+
+	def register(self, fd, events):
+		self.fds[fd] = events
+
+	modify = register
+
+	def unregister(self, fd):
+		self.fds.pop(fd, None)
+
+	def poll(self, timeout):
+		r = [fd for fd, e in self.fds.items() if e & READ]
+		w = [fd for fd, e in self.fds.items() if e & WRITE]
+		try:
+			r, w, x = select.select(r, w, [], timeout)
+		except select.error, e:
+			if e.args[0] == errno.EINTR:
+				return []
+			raise
+		events = {}
+		for fd in r:
+			events[fd] = READ
+		for fd in w:
+			events[fd] = events.get(fd, 0) | WRITE
+		return events.items()
+
+def poller():
+	if hasattr(select, "epoll"):
+		return EpollPoller()
+	return SelectPoller()
+
+#------------------------------
+# Requests
+#------------------------------
+
+class BufferedHandler(FordHTTPRequestHandler):
+	"""Answers one request read from memory, leaving the body unsent.
+
+	The event loop sends what is written to wfile, then the FileBody left
+	in self.body, so a slow client never holds a worker.
+	"""
+
+	def setup(self):
+		self.connection = None
+		self.body = None
+		self.rfile = StringIO(self.request)
+		self.wfile = StringIO()
+
+	def handle(self):
+		self.handle_one_request()
+
+	def finish(self):
+		pass
+
+	def do_GET(self):
+		body = self.send_head()
+		if body is None:
+			return
+		if isinstance(body, FileBody):
+			self.body = body
+		else:
+			try:
+				self.copyfile(body, self.wfile)
+			finally:
+				body.close()
+
+def answer(request, address, server):
+	"""Returns the head, file body and whether to close after them."""
+	h = BufferedHandler(request, address, server)
+	return h.wfile.getvalue(), h.body, h.close_connection
+
+def _header_end(buf):
+	i = buf.find("\r\n\r\n")
+	if i >= 0:
+		return i + 4
+	i = buf.find("\n\n")
+	if i >= 0:
+		return i + 2
+	return -1
+
+def _has_body(head):
+	for line in head.split("\n")[1:]:
+		k, sep, v = line.partition(":")
+		k = k.strip().lower()
+		if k == "transfer-encoding" or (k == "content-length"
+				and v.strip() not in ["", "0"]):
+			return True
+	return False
+
+#------------------------------
+# Connections
+#------------------------------
+
+class Connection(object):
+	def __init__(self, sock, address, handshaking=False):
+		self.sock = sock
+		self.fd = sock.fileno()
+		self.address = address
+		self.handshaking = handshaking
+		self.inbuf = ""
+		self.outbuf = ""
+		# How much of outbuf is sent; slicing off the rest would copy it
+		self.sent = 0
+		self.body = None
+		self.offset = 0
+		self.remaining = 0
+		# A worker is answering a request or reading the body
+		self.busy = False
+		self.close_after = False
+		self.events = READ
+		self.last_active = time()
+
+	def recv(self):
+		"""Reads what is available, returning False on end of stream."""
+		while True:
+			try:
+				data = self.sock.recv(RECV_CHUNK)
+			except socket.error, e:
+				if _would_block(e):
+					return True
+				return False
+			if not data:
+				return False
+			self.inbuf += data
+			# TLS may have decrypted more than one recv returns
+			if not (hasattr(self.sock, "pending") and self.sock.pending()):
+				return True
+
+	def send(self):
+		"""Sends what it can of outbuf, returning False if the peer is gone."""
+		while self.sent < len(self.outbuf):
+			try:
+				sent = self.sock.send(
+						self.outbuf[self.sent:self.sent + SEND_CHUNK])
+			except socket.error, e:
+				return _would_block(e)
+			self.sent += sent
+		self.outbuf, self.sent = "", 0
+		return True
+
+	def close(self):
+		if self.body is not None:
+			self.body.close()
+			self.body = None
+		try:
+			self.sock.close()
+		except socket.error:
+			pass
+
+def _would_block(e):
+	if ssl is not None and isinstance(e, ssl.SSLError):
+		return e.args[0] in [ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE]
+	return e.args[0] in [errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR]
+
+#------------------------------
+# Server
+#------------------------------
+
+class EventServer(object):
+	"""Serves the current directory on any number of ports from one loop.
+
+	listeners are (port, cert) pairs; a cert file makes the port HTTPS.
+	"""
+
+	verbose = False
+
+	def __init__(self, listeners, max_connections=MAX_CONNECTIONS,
+			keepalive_timeout=KEEPALIVE_TIMEOUT, workers=WORKERS):
+		self.max_connections = max_connections
+		self.keepalive_timeout = keepalive_timeout
+		self.poller = poller()
+		self.listeners = {}
+		self.conns = {}
+		self.jobs = Queue()
+		self.done = Queue()
+		self.wake_r, self.wake_w = os.pipe()
+		for fd in [self.wake_r, self.wake_w]:
+			_nonblocking(fd)
+		self.poller.register(self.wake_r, READ)
+
+		for port, cert in listeners:
+			self.listen(port, cert)
+		for i in range(workers):
+			t = Thread(target=self._work)
+			t.daemon = True
+			t.start()
+
+	def listen(self, port, cert=None):
+		context = None
+		if cert is not None:
+			context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+			try:
+				context.load_cert_chain(cert)
+			except (IOError, ssl.SSLError):
+				print "There seems to be a problem with your ford SSL cert"
+				print "Please regenerate this cert by running: "
+				print "\n\tford mkcert\n"
+				exit(1)
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		sock.bind(("", port))
+		sock.listen(128)
+		sock.setblocking(0)
+		self.listeners[sock.fileno()] = (sock, context)
+		self.poller.register(sock.fileno(), READ)
+		print "Serving {0} on port {1} ...".format(
+				"HTTP" if context is None else "HTTPS", port)
+
+	def serve_forever(self):
+		try:
+			while True:
+				self._timeouts()
+				for fd, events in self.poller.poll(1.0):
+					if fd == self.wake_r:
+						self._drain_wake()
+					elif fd in self.listeners:
+						self._accept(*self.listeners[fd])
+					elif fd in self.conns:
+						self._ready(self.conns[fd], events)
+				self._finished()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			for conn in self.conns.values():
+				conn.close()
+
+	#------------------------------
+	# Workers
+	#------------------------------
+
+	def _work(self):
+		while True:
+			conn, fn, args = self.jobs.get()
+			try:
+				result = fn(*args)
+			except Exception, e:
+				result = e
+			self.done.put((conn, fn, result))
+			try:
+				os.write(self.wake_w, "x")
+			except OSError:
+				pass
+
+	def _submit(self, conn, fn, *args):
+		conn.busy = True
+		self._watch(conn, 0)
+		self.jobs.put((conn, fn, args))
+
+	def _drain_wake(self):
+		try:
+			while os.read(self.wake_r, 4096):
+				pass
+		except OSError:
+			pass
+
+	def _finished(self):
+		while True:
+			try:
+				conn, fn, result = self.done.get_nowait()
+			except Empty:
+				return
+			conn.busy = False
+			if self.conns.get(conn.fd) is not conn:
+				# Closed while the worker ran
+				if fn is answer and not isinstance(result, Exception):
+					if result[1] is not None:
+						result[1].close()
+				continue
+			if isinstance(result, Exception):
+				self._close(conn)
+			elif fn is answer:
+				self._respond(conn, *result)
+			else:
+				self._chunk(conn, result)
+
+	#------------------------------
+	# Connections
+	#------------------------------
+
+	def _accept(self, sock, context):
+		while True:
+			try:
+				client, address = sock.accept()
+			except socket.error, e:
+				if _would_block(e) or e.args[0] == errno.ECONNABORTED:
+					return
+				raise
+			if len(self.conns) >= self.max_connections:
+				if context is None:
+					try:
+						client.send(BUSY)
+					except socket.error:
+						pass
+				client.close()
+				continue
+			client.setblocking(0)
+			client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			if context is not None:
+				client = context.wrap_socket(client, server_side=True,
+						do_handshake_on_connect=False)
+			conn = Connection(client, address, context is not None)
+			self.conns[conn.fd] = conn
+			self.poller.register(conn.fd, READ)
+
+	def _watch(self, conn, events):
+		if events != conn.events:
+			conn.events = events
+			self.poller.modify(conn.fd, events)
+
+	def _close(self, conn):
+		if self.conns.pop(conn.fd, None) is not None:
+			self.poller.unregister(conn.fd)
+		conn.close()
+
+	def _timeouts(self):
+		now = time()
+		for conn in self.conns.values():
+			idle = not conn.busy and not conn.outbuf and conn.body is None
+			if idle and now - conn.last_active > self.keepalive_timeout:
+				self._close(conn)
+
+	def _handshake(self, conn):
+		try:
+			conn.sock.do_handshake()
+		except ssl.SSLError, e:
+			if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+				self._watch(conn, READ)
+			elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+				self._watch(conn, WRITE)
+			else:
+				self._close(conn)
+			return
+		except socket.error:
+			self._close(conn)
+			return
+		conn.handshaking = False
+		self._watch(conn, READ)
+		# The request may have arrived with the end of the handshake
+		self._ready(conn, READ)
+
+	def _ready(self, conn, events):
+		conn.last_active = time()
+		if conn.handshaking:
+			self._handshake(conn)
+			return
+		if events & READ and not conn.busy:
+			if not conn.recv():
+				self._close(conn)
+				return
+			self._next_request(conn)
+		if events & WRITE and conn.fd in self.conns:
+			if not conn.send():
+				self._close(conn)
+				return
+			if not conn.outbuf:
+				self._sent(conn)
+
+	def _next_request(self, conn):
+		"""Hands the next complete request in inbuf to a worker."""
+		if conn.busy or conn.outbuf or conn.body is not None:
+			return
+		end = _header_end(conn.inbuf)
+		# A whole header can arrive in one recv, so check complete ones too
+		if end > MAX_HEADER or (end < 0 and len(conn.inbuf) > MAX_HEADER):
+			conn.inbuf = ""
+			conn.outbuf = TOO_LARGE
+			conn.close_after = True
+			self._watch(conn, WRITE)
+			return
+		if end < 0:
+			return
+		head, conn.inbuf = conn.inbuf[:end], conn.inbuf[end:]
+		# Static files take no request bodies; answer, then drop the rest
+		if _has_body(head):
+			conn.inbuf = ""
+			conn.close_after = True
+		self._submit(conn, answer, head, conn.address, self)
+
+	def _respond(self, conn, head, body, close):
+		conn.close_after = conn.close_after or close
+		conn.outbuf = head
+		if body is not None:
+			if body.data is not None:
+				conn.outbuf += body.data[body.start:body.start + body.length]
+			else:
+				conn.body = body
+				conn.offset, conn.remaining = body.start, body.length
+		self._watch(conn, WRITE)
+
+	def _chunk(self, conn, data):
+		if not data:
+			conn.remaining = 0
+			conn.close_after = True
+		conn.outbuf = data
+		conn.offset += len(data)
+		conn.remaining -= len(data)
+		self._watch(conn, WRITE)
+
+	def _sent(self, conn):
+		"""Moves on once outbuf is empty: more body, the next request or close."""
+		if conn.body is not None:
+			if conn.remaining > 0:
+				self._submit(conn, _read, conn.body, conn.offset,
+						min(READ_CHUNK, conn.remaining))
+				return
+			conn.body.close()
+			conn.body = None
+		if conn.close_after:
+			self._close(conn)
+			return
+		self._watch(conn, READ)
+		# Pipelined requests are already waiting
+		self._next_request(conn)
+
+def _read(body, offset, length):
+	body.f.seek(offset)
+	return body.f.read(length)
+
+def _nonblocking(fd):
+	flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+	fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def serve(listeners, **limits):
+	"""Runs an EventServer from the current directory until interrupted."""
+	for port, cert in listeners:
+		if cert is not None and not hasattr(ssl, "SSLContext"):
+			print "This Python's ssl module cannot serve HTTPS without blocking"
+			print "Please upgrade to Python 2.7.9 or newer for event hosting."
+			exit(1)
+	EventServer(listeners, **limits).serve_forever()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+"""Concurrent fetching of remote resources for Ford updates."""
+
+from hashlib import sha256
+from httplib import HTTPConnection, HTTPSConnection, HTTPException
+from os import remove, rename, close as close_fd
+from os.path import isfile, getsize
+from Queue import Queue, Empty
+from re import match
+from shutil import rmtree
+from socket import error as SocketError
+from tempfile import mkdtemp, mkstemp
+from threading import Thread, Lock
+from urllib import getproxies
+from urllib2 import urlopen, Request, HTTPError
+from urlparse import urlsplit, urljoin
+
+from utilities import read_file, write_file
+
+DEFAULT_JOBS = 8
+CHUNK = 64 * 1024
+MAX_REDIRECTS = 5
+REDIRECTS = [301, 302, 303, 307, 308]
+USER_AGENT = "Ford"
+
+# Set while updating offline; nothing may be downloaded
+offline = False
+
+class OfflineError(Exception):
+	"""Raised instead of opening a connection while offline."""
+
+	def __init__(self, url):
+		Exception.__init__(self, url)
+		self.url = url
+
+#------------------------------
+# Streaming
+#------------------------------
+
+class Download(object):
+	"""Streams a response body into a file, hashing it on the way.
+
+	A 206 response is appended to what the file already holds, which is
+	hashed first, so the digest always covers the whole file. The ETag or
+	Last-Modified of the response that started the file is kept beside it,
+	for resuming with If-Range.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.meta = path + ".validator"
+		self.stream = None
+		self.hash = None
+
+	def offset(self):
+		if isfile(self.path):
+			return getsize(self.path)
+		return 0
+
+	def validator(self):
+		"""Returns what identifies the file's version, if the server sent it."""
+		if isfile(self.meta) and isfile(self.path):
+			return read_file(self.meta) or None
+		return None
+
+	def discard(self):
+		for fp in [self.path, self.meta]:
+			if isfile(fp):
+				remove(fp)
+
+	def finish(self, dest):
+		rename(self.path, dest)
+		if isfile(self.meta):
+			remove(self.meta)
+
+	def open(self, status, headers):
+		self.hash = sha256()
+		if status != 206:
+			# Weak ETags cannot be used with If-Range
+			etag = headers.get("etag") or ""
+			if etag.startswith("W/"):
+				etag = ""
+			write_file(self.meta, etag or headers.get("last-modified") or "")
+			self.stream = open(self.path, "wb")
+			return
+		m = match(r"bytes (\d+)-", headers.get("content-range") or "")
+		start = int(m.group(1)) if m is not None else 0
+		if start > self.offset():
+			raise HTTPException("{0}: unexpected Content-Range {1}".format(
+					self.path, headers.get("content-range")))
+		self.stream = open(self.path, "r+b")
+		while self.stream.tell() < start:
+			chunk = self.stream.read(min(CHUNK, start - self.stream.tell()))
+			self.hash.update(chunk)
+		self.stream.truncate(start)
+
+	def write(self, chunk):
+		self.stream.write(chunk)
+		self.hash.update(chunk)
+
+	def close(self):
+		if self.stream is not None:
+			self.stream.close()
+			self.stream = None
+
+	def digest(self):
+		return self.hash.hexdigest()
+
+def _stream(resp, status, headers, sink):
+	"""Copies resp into sink a chunk at a time."""
+	sink.open(status, headers)
+	try:
+		while True:
+			chunk = resp.read(CHUNK)
+			if not chunk:
+				break
+			sink.write(chunk)
+	finally:
+		sink.close()
+
+#------------------------------
+# Connection pooling
+#------------------------------
+
+class ConnectionPool(object):
+	"""Keeps persistent connections open, keyed by scheme and host."""
+
+	def __init__(self):
+		self.idle = {}
+		self.lock = Lock()
+		self.opened = 0
+		self.reused = 0
+
+	def _connect(self, scheme, netloc):
+		with self.lock:
+			self.opened += 1
+		if scheme == "https":
+			return HTTPSConnection(netloc)
+		return HTTPConnection(netloc)
+
+	def _acquire(self, scheme, netloc):
+		with self.lock:
+			conns = self.idle.get((scheme, netloc))
+			if conns:
+				self.reused += 1
+				return conns.pop(), True
+		return self._connect(scheme, netloc), False
+
+	def _release(self, scheme, netloc, conn):
+		with self.lock:
+			self.idle.setdefault((scheme, netloc), []).append(conn)
+
+	def _send(self, scheme, netloc, path, headers):
+		conn, reused = self._acquire(scheme, netloc)
+		try:
+			conn.request("GET", path, headers=headers)
+			return conn, conn.getresponse()
+		except (HTTPException, SocketError):
+			conn.close()
+			if not reused:
+				raise
+		# The server dropped an idle connection; retry on a fresh one
+		conn = self._connect(scheme, netloc)
+		conn.request("GET", path, headers=headers)
+		return conn, conn.getresponse()
+
+	def request(self, url, headers=None, sink=None):
+		"""Performs a GET, following redirects, and returns the response.
+
+		With a sink a successful body is streamed into it, not returned.
+		"""
+		for i in range(MAX_REDIRECTS + 1):
+			scheme, netloc, path, query, fragment = urlsplit(url)
+			if not path:
+				path = "/"
+			if query:
+				path = "?".join([path, query])
+
+			h = {"User-Agent": USER_AGENT}
+			if headers is not None:
+				h.update(headers)
+
+			conn, resp = self._send(scheme, netloc, path, h)
+			data = None
+			if sink is not None and resp.status in [200, 206]:
+				try:
+					_stream(resp, resp.status, resp.msg, sink)
+				except:
+					# What is left of the body is unread
+					conn.close()
+					raise
+			else:
+				data = resp.read()
+			if resp.will_close:
+				conn.close()
+			else:
+				self._release(scheme, netloc, conn)
+
+			location = resp.getheader("location")
+			if resp.status in REDIRECTS and location is not None:
+				url = urljoin(url, location)
+				continue
+
+			if resp.status >= 400:
+				raise HTTPError(url, resp.status, resp.reason, resp.msg, None)
+			return resp.status, resp.msg, data
+
+		raise HTTPError(url, resp.status, "Too many redirects", resp.msg, None)
+
+	def close(self):
+		with self.lock:
+			for conns in self.idle.values():
+				for conn in conns:
+					conn.close()
+			self.idle = {}
+
+pool = ConnectionPool()
+
+def download(url, headers=None, sink=None):
+	"""Fetches a url, returning the response status, headers and body.
+
+	The body is None when it was streamed into sink.
+	"""
+	if offline:
+		raise OfflineError(url)
+	scheme = urlsplit(url)[0]
+	# Leave proxied requests to urllib2, which knows how to route them
+	if scheme in getproxies():
+		try:
+			resp = urlopen(Request(url, headers=headers or {}))
+		except HTTPError as e:
+			if e.code != 304:
+				raise
+			return e.code, e.headers, ""
+		if sink is None:
+			return resp.code, resp.headers, resp.read()
+		_stream(resp, resp.code, resp.headers, sink)
+		return resp.code, resp.headers, None
+	return pool.request(url, headers, sink)
+
+#------------------------------
+# Prefetching
+#------------------------------
+
+# Prefetched bodies wait in temporary files until get() asks for them
+prefetched = {}
+prefetch_lock = Lock()
+prefetch_dir = None
+
+def _prefetch_worker(queue):
+	while True:
+		try:
+			url, headers = queue.get_nowait()
+		except Empty:
+			return
+		fd, path = mkstemp(dir=prefetch_dir)
+		close_fd(fd)
+		try:
+			result = (download(url, headers, Download(path)) + (path,), None)
+		except Exception as e:
+			result = (None, e)
+		with prefetch_lock:
+			prefetched[url] = (headers, result)
+
+def prefetch(requests, jobs=DEFAULT_JOBS):
+	"""Downloads (url, headers) pairs in parallel, holding them for get()."""
+	global prefetch_dir
+	if offline:
+		return 0
+	if prefetch_dir is None:
+		prefetch_dir = mkdtemp(prefix="ford_prefetch_")
+	queue = Queue()
+	seen = set()
+	for url, headers in requests:
+		if url in seen or url in prefetched:
+			continue
+		seen.add(url)
+		queue.put((url, headers))
+
+	threads = []
+	for i in range(min(jobs, len(seen))):
+		t = Thread(target=_prefetch_worker, args=[queue])
+		t.daemon = True
+		t.start()
+		threads.append(t)
+	for t in threads:
+		t.join()
+
+	return len(seen)
+
+def get(url, headers=None, sink=None):
+	"""Returns the status, headers and body for a url, using prefetches."""
+	with prefetch_lock:
+		entry = prefetched.pop(url, None)
+
+	# Only use a prefetch made with the same (conditional) request headers
+	if entry is not None and entry[0] != headers:
+		if entry[1][0] is not None:
+			remove(entry[1][0][3])
+		entry = None
+	if entry is None:
+		return download(url, headers, sink)
+
+	resp, err = entry[1]
+	if err is not None:
+		raise err
+	status, resp_headers, data, path = resp
+	try:
+		# Only successful bodies were streamed to the file
+		if data is None:
+			with open(path, "rb") as f:
+				if sink is None:
+					data = f.read()
+				else:
+					_stream(f, status, resp_headers, sink)
+		return status, resp_headers, data
+	finally:
+		remove(path)
+
+def clear():
+	"""Drops prefetched bodies nobody asked for."""
+	global prefetch_dir
+	with prefetch_lock:
+		prefetched.clear()
+		if prefetch_dir is not None:
+			rmtree(prefetch_dir, True)
+			prefetch_dir = None
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Names built files by their content, so unchanged files keep their urls.
+
+application.min.js is published as application.<hash>.min.js, and the
+asset map (assets.json in the output directory) says which logical name
+went to which file, for every build target writing to that directory. A
+file whose content did not change keeps its name, and with it every
+browser and CDN copy.
+"""
+
+from fcntl import flock, LOCK_EX, LOCK_UN
+from json import dumps, loads
+from os import remove, close, open as os_open, O_RDONLY
+from os.path import join, dirname, basename, isfile, normpath, relpath
+from re import compile as regex
+
+from cache import content_hash
+from utilities import read_file, replace_file
+
+ASSET_MAP = "assets.json"
+HASH_LENGTH = 12
+
+# Matches the names fingerprinted() makes
+FINGERPRINTED = regex(r"\.[0-9a-f]{%d}\." % HASH_LENGTH)
+
+def fingerprinted(name, digest):
+	"""Puts the hash after the first part of a name: a.min.js, a.<h>.min.js"""
+	parts = basename(name).split(".", 1)
+	parts.insert(1, digest[:HASH_LENGTH])
+	return join(dirname(name), ".".join(parts))
+
+class AssetMap(object):
+	"""The fingerprinted name of each logical output name."""
+
+	def __init__(self, root):
+		self.root = root
+		self.path = join(root, ASSET_MAP)
+		self.names = {}
+		self.saved = self._load()
+
+	def _load(self):
+		if isfile(self.path):
+			try:
+				return loads(read_file(self.path))
+			except ValueError:
+				pass
+		return {}
+
+	def name(self, fp):
+		"""Returns the output relative name of a file, if it is an output."""
+		rel = relpath(normpath(fp), self.root)
+		if rel.startswith(".."):
+			return None
+		return rel
+
+	def add(self, fp, data=None):
+		"""Publishes fp (or data in its place) under its fingerprinted name."""
+		rel = self.name(fp)
+		if data is None:
+			data = read_file(fp)
+		hashed = fingerprinted(rel, content_hash(data))
+		if not isfile(join(self.root, hashed)):
+			replace_file(join(self.root, hashed), data)
+		self.names[rel] = hashed
+		return hashed
+
+	def save(self):
+		"""Merges what this build published into the map on disk.
+
+		Build targets share an output directory and its map, so only the
+		names this build published again are replaced, and only the files
+		they replaced are removed.
+		"""
+		# Targets building in parallel save the same map
+		fd = os_open(self.root, O_RDONLY)
+		flock(fd, LOCK_EX)
+		try:
+			self.saved = self._load()
+			merged = dict(self.saved)
+			merged.update(self.names)
+			current = set(merged.values())
+			for rel in self.names:
+				hashed = self.saved.get(rel)
+				if hashed is None or hashed in current:
+					continue
+				for suffix in ["", ".gz", ".br"]:
+					fp = join(self.root, hashed + suffix)
+					if isfile(fp):
+						remove(fp)
+			if merged != self.saved:
+				replace_file(self.path, dumps(merged, sort_keys=True, indent=1))
+				self.saved = merged
+		finally:
+			flock(fd, LOCK_UN)
+			close(fd)
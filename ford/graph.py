@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""A persisted record of build steps, used to skip work that is current."""
+
+from hashlib import sha256
+from json import dumps, loads
+from os import stat, walk
+from os.path import join, isfile, isdir, dirname
+
+from utilities import read_file, write_file, mkdirp
+
+class BuildGraph(object):
+	"""Maps each build step to the inputs and outputs of its last run.
+
+	A step is fresh when the digests of its inputs and its values match the
+	last recorded run and all of its outputs are still intact. File digests
+	are reused while a file's mtime and size are unchanged.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.steps = {}
+		self.files = {}
+		if isfile(path):
+			try:
+				data = loads(read_file(path))
+				self.steps = data["steps"]
+				self.files = data["files"]
+			except (ValueError, KeyError):
+				pass
+
+	def digest(self, path):
+		try:
+			st = stat(path)
+		except OSError:
+			return None
+		known = self.files.get(path)
+		if known and known[0] == st.st_mtime and known[1] == st.st_size:
+			return known[2]
+		d = sha256(read_file(path)).hexdigest()
+		self.files[path] = [st.st_mtime, st.st_size, d]
+		return d
+
+	def tree(self, path):
+		"""Lists every file under a directory, or the path itself if a file."""
+		if not isdir(path):
+			return [path]
+		files = []
+		for root, dirs, names in walk(path):
+			dirs.sort()
+			for n in sorted(names):
+				files.append(join(root, n))
+		return files
+
+	def _key(self, inputs, values):
+		h = sha256(dumps(values, sort_keys=True))
+		for p in inputs:
+			h.update(p)
+			h.update(self.digest(p) or "-")
+		return h.hexdigest()
+
+	def fresh(self, step, inputs=None, values=None):
+		"""Checks a step against its last run; inputs default to the last."""
+		rec = self.steps.get(step)
+		if rec is None:
+			return False
+		if inputs is None:
+			inputs = rec["inputs"]
+		if rec["key"] != self._key(inputs, values):
+			return False
+		for o in rec["outputs"]:
+			if self.digest(o) != rec["outputs"][o]:
+				return False
+		return True
+
+	def record(self, step, inputs, values, outputs):
+		self.steps[step] = {
+			"key": self._key(inputs, values),
+			"inputs": inputs,
+			"outputs": dict((o, self.digest(o)) for o in outputs)
+		}
+
+	def save(self):
+		mkdirp(dirname(self.path))
+		write_file(self.path, dumps({"steps": self.steps, "files": self.files}))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""The ford.lock file: what every library resolved to at its last update.
+
+For each library the lock keeps the hash of the manifest it was resolved
+from, the uri and version of each resource, and the sha256 of every file
+the update left in lib/<lib>. While the manifest is unchanged and the blob
+store holds every file, the library can be put back without resolving its
+manifest or touching the network.
+"""
+
+from json import dumps, loads
+from os import walk
+from os.path import join, isdir, isfile, islink, relpath
+from shutil import rmtree
+
+from cache import store_blob, has_blob, restore_blob
+from utilities import read_file, replace_file
+
+LOCK_VERSION = 1
+
+class LockFile(object):
+
+	def __init__(self, path, fresh=False):
+		self.path = path
+		self.data = {"version": LOCK_VERSION, "manifest": None,
+				"libraries": {}}
+		self.saved = None
+		if isfile(path):
+			try:
+				data = loads(read_file(path))
+				if data.get("version") == LOCK_VERSION:
+					self.saved = data
+					if not fresh:
+						self.data = loads(dumps(data))
+			except ValueError:
+				pass
+
+	def library(self, lib, manifest_hash):
+		"""Returns a library's entry if it can be restored as locked."""
+		entry = self.data["libraries"].get(lib)
+		if entry is None or entry["manifest"] != manifest_hash:
+			return None
+		for digest in entry["files"].values():
+			if not has_blob(digest):
+				return None
+		return entry
+
+	def restore(self, entry, lib_dir):
+		# Files the locked update did not leave must not survive it
+		if isdir(lib_dir) and not islink(lib_dir):
+			rmtree(lib_dir)
+		for name, digest in entry["files"].items():
+			restore_blob(digest, join(lib_dir, name))
+
+	def record(self, lib, manifest_hash, resources, lib_dir):
+		"""Locks a library to the files its update left in lib_dir.
+
+		Every file goes into the blob store, even with --no-cache, since a
+		lock whose blobs are missing can never be restored.
+		"""
+		files = {}
+		for root, dirs, names in walk(lib_dir):
+			for n in names:
+				fp = join(root, n)
+				if islink(fp):
+					continue
+				files[relpath(fp, lib_dir)] = store_blob(fp)
+		self.data["libraries"][lib] = {
+			"manifest": manifest_hash,
+			"resources": resources,
+			"files": files
+		}
+
+	def save(self, manifest_hash):
+		self.data["manifest"] = manifest_hash
+		if self.data == self.saved:
+			return False
+		replace_file(self.path, dumps(self.data, sort_keys=True, indent=1))
+		self.saved = loads(dumps(self.data))
+		return True
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+"""HTML parser backends for building index pages and component HTML.
+
+The build only needs a handful of tree operations; each backend provides
+them over its own tree, so the rest of Ford never touches parser objects
+directly.
+"""
+
+from copy import deepcopy
+from re import compile as regex, IGNORECASE
+
+from BeautifulSoup import BeautifulSoup, Tag, NavigableString
+
+try:
+	import lxml.html
+	from lxml import etree
+except ImportError:
+	lxml = None
+
+DEFAULT_MARKUP = "beautifulsoup"
+
+DOCTYPE = regex(r"^\s*<!doctype", IGNORECASE)
+
+# Add tags to beautifulsoup or HTML will not build properly
+CUSTOM_TAGS = ("group", "component", "def", "sect")
+BeautifulSoup.NESTABLE_BLOCK_TAGS += CUSTOM_TAGS
+for t in CUSTOM_TAGS:
+	BeautifulSoup.NESTABLE_TAGS[t] = []
+
+class Markup(object):
+	"""The tree operations the build uses.
+
+	Backends provide parse, fragment, render, element, clone, is_element,
+	tag, get, set, text, set_text, find_all, children, contents,
+	insert_before, insert_after, replace and extract; get() returns None
+	for a missing attribute.
+
+	Nodes are elements or text; find_all() and children() only return
+	elements. contents() returns both, in document order, and those are
+	what insert_before() accepts.
+	"""
+
+	name = None
+
+	def available(self):
+		return True
+
+class SoupMarkup(Markup):
+	"""BeautifulSoup 3, Ford's original and most forgiving parser."""
+
+	name = "beautifulsoup"
+
+	def __init__(self):
+		# Tags take their parsing flags from a parser instance
+		self.parser = BeautifulSoup()
+
+	def _index(self, node):
+		# Tag equality compares markup; we want this very node
+		for i, child in enumerate(node.parent.contents):
+			if child is node:
+				return i
+		return -1
+
+	def parse(self, html):
+		return BeautifulSoup(html)
+
+	def fragment(self, html):
+		return BeautifulSoup(html)
+
+	def render(self, doc):
+		return str(doc)
+
+	def element(self, name, attrs=None):
+		return Tag(self.parser, name, list(attrs or []))
+
+	def clone(self, node):
+		if isinstance(node, NavigableString):
+			return node.__class__(node[:])
+		clone = self.element(node.name, node.attrs)
+		for child in node.contents:
+			clone.append(self.clone(child))
+		return clone
+
+	def is_element(self, node):
+		return isinstance(node, Tag)
+
+	def tag(self, element):
+		return element.name
+
+	def get(self, element, attr):
+		return element.get(attr)
+
+	def set(self, element, attr, value):
+		element[attr] = value
+
+	def text(self, element):
+		return element.string
+
+	def set_text(self, element, text):
+		element.string = text
+
+	def find_all(self, node, name=None, **attrs):
+		return node.findAll(name, attrs)
+
+	def children(self, node):
+		return [c for c in node.contents if isinstance(c, Tag)]
+
+	def contents(self, node):
+		return list(node.contents)
+
+	def insert_before(self, ref, node):
+		ref.parent.insert(self._index(ref), node)
+
+	def insert_after(self, ref, node):
+		ref.parent.insert(self._index(ref) + 1, node)
+
+	def replace(self, old, new):
+		old.replaceWith(new)
+
+	def extract(self, node):
+		node.extract()
+
+class LxmlMarkup(Markup):
+	"""libxml2's HTML parser through lxml; much faster on big templates.
+
+	lxml keeps text as the .text and .tail of elements, so text nodes are
+	plain strings here and an element carries its tail when it moves.
+	"""
+
+	name = "lxml"
+
+	def available(self):
+		return lxml is not None
+
+	def parse(self, html):
+		doc = lxml.html.document_fromstring(html)
+		# libxml2 makes up a doctype for documents without one
+		if not DOCTYPE.match(html):
+			doc.getroottree().docinfo.clear()
+		return doc
+
+	def fragment(self, html):
+		return lxml.html.fragment_fromstring(html, create_parent="div")
+
+	def render(self, doc):
+		return etree.tostring(doc.getroottree(), method="html",
+				encoding="utf-8")
+
+	def element(self, name, attrs=None):
+		element = lxml.html.Element(name)
+		for k, v in attrs or []:
+			self.set(element, k, v)
+		return element
+
+	def clone(self, node):
+		if not self.is_element(node):
+			return node[:]
+		return deepcopy(node)
+
+	def is_element(self, node):
+		return not isinstance(node, basestring)
+
+	def tag(self, element):
+		return element.tag
+
+	def get(self, element, attr):
+		return element.get(attr)
+
+	def _unicode(self, text):
+		# lxml only takes byte strings when they are plain ascii
+		if isinstance(text, str):
+			return text.decode("utf-8")
+		return text
+
+	def set(self, element, attr, value):
+		element.set(attr, self._unicode(value))
+
+	def text(self, element):
+		return element.text
+
+	def set_text(self, element, text):
+		element.text = self._unicode(text)
+
+	def find_all(self, node, name=None, **attrs):
+		found = []
+		for element in node.iterdescendants(name or etree.Element):
+			for k in attrs:
+				if element.get(k) != attrs[k]:
+					break
+			else:
+				found.append(element)
+		return found
+
+	def children(self, node):
+		return [c for c in node if isinstance(c.tag, basestring)]
+
+	def contents(self, node):
+		nodes = []
+		if node.text:
+			nodes.append(node.text)
+		nodes.extend(node)
+		return nodes
+
+	def _add_text(self, ref, text):
+		# Text before ref belongs to the previous sibling's tail
+		prev = ref.getprevious()
+		if prev is not None:
+			prev.tail = (prev.tail or "") + text
+		else:
+			parent = ref.getparent()
+			parent.text = (parent.text or "") + text
+
+	def insert_before(self, ref, node):
+		if not self.is_element(node):
+			self._add_text(ref, self._unicode(node))
+		else:
+			ref.addprevious(node)
+
+	def insert_after(self, ref, node):
+		# Keep ref's tail after the new node, as it is after ref
+		tail = ref.tail
+		ref.tail = None
+		ref.addnext(node)
+		node.tail = (node.tail or "") + (tail or "") or None
+
+	def replace(self, old, new):
+		new.tail = old.tail
+		old.getparent().replace(old, new)
+
+	def extract(self, node):
+		node.drop_tree()
+
+MARKUPS = {
+	SoupMarkup.name: SoupMarkup,
+	LxmlMarkup.name: LxmlMarkup
+}
+
+def get_markup(name=None):
+	if name is None:
+		name = DEFAULT_MARKUP
+	if not name in MARKUPS:
+		raise KeyError(name)
+	return MARKUPS[name]()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Shared, shallow mirrors of the git repositories libraries come from.
+
+Each repository is fetched once into a bare mirror under the Ford cache,
+one commit deep, and later updates only fetch what changed. Commits are
+checked out as worktrees next to the mirror, one per commit, so every
+project on the host reads the same checkout of the same commit. Only the
+MAX_TREES most recently used checkouts of a repository are kept.
+"""
+
+from fcntl import flock, LOCK_EX, LOCK_UN
+from hashlib import sha1
+from os import listdir, utime
+from os.path import join, isdir, basename, getmtime
+from re import compile as regex, sub
+from shutil import rmtree
+from subprocess import Popen, PIPE, STDOUT
+
+import fetch
+from cache import CACHE_DIR
+from utilities import mkdirp
+
+MIRROR_DIR = join(CACHE_DIR, ".mirrors")
+COMMIT = regex(r"^[0-9a-f]{40}$")
+MAX_TREES = 4
+
+class MirrorError(Exception):
+	pass
+
+def _git(mirror, *args):
+	cmd = ["git", "--git-dir", mirror] + list(args)
+	process = Popen(cmd, stdout=PIPE, stderr=STDOUT)
+	out = process.communicate()[0]
+	if process.returncode != 0:
+		raise MirrorError("{0}: {1}".format(" ".join(cmd), out.strip()))
+	return out.strip()
+
+def mirror_path(uri, mirror_dir=MIRROR_DIR):
+	name = sub(r"\.git$", "", basename(uri.rstrip("/"))) or "repo"
+	key = sha1(uri).hexdigest()[:12]
+	return join(mirror_dir, "{0}-{1}.git".format(name, key))
+
+def _commit(mirror, rev):
+	try:
+		return _git(mirror, "rev-parse", "--verify", "-q", rev + "^{commit}")
+	except MirrorError:
+		return None
+
+def _fetch(mirror, uri, ref, local_ref):
+	if fetch.offline:
+		raise fetch.OfflineError(uri)
+	if not isdir(mirror):
+		mkdirp(mirror)
+		_git(mirror, "init", "--bare", "-q")
+		_git(mirror, "remote", "add", "origin", uri)
+	_git(mirror, "fetch", "-q", "--depth", "1", "origin", ref or "HEAD")
+	_git(mirror, "update-ref", local_ref, "FETCH_HEAD")
+
+def _prune_trees(mirror, trees, keep):
+	"""Removes all but the MAX_TREES most recently used checkouts."""
+	used = sorted([(getmtime(join(trees, t)), t) for t in listdir(trees)],
+			reverse=True)
+	removed = False
+	for mtime, name in used[MAX_TREES:]:
+		if name != keep:
+			rmtree(join(trees, name), True)
+			removed = True
+	if removed:
+		# Forget worktrees whose directories were removed
+		_git(mirror, "worktree", "prune")
+
+def checkout(uri, ref=None, update=True, mirror_dir=MIRROR_DIR):
+	"""Returns the path of a checkout of uri at ref, and if it was fetched.
+
+	ref is a branch, tag or commit, and the remote HEAD by default. Without
+	update the commit last fetched for ref is used, so only refs never
+	fetched before touch the network. Commits are never fetched twice.
+	Mirrors live in mirror_dir, the shared cache unless told otherwise.
+	"""
+	mirror = mirror_path(uri, mirror_dir)
+	mkdirp(mirror_dir)
+	local_ref = "refs/ford/" + sha1(ref or "HEAD").hexdigest()[:12]
+
+	# Projects updating in parallel share the mirror
+	with open(mirror + ".lock", "w") as lock:
+		flock(lock, LOCK_EX)
+		try:
+			commit = None
+			if isdir(mirror):
+				if ref is not None and COMMIT.match(ref):
+					commit = _commit(mirror, ref)
+				elif not update:
+					commit = _commit(mirror, local_ref)
+
+			fetched = commit is None
+			if fetched:
+				_fetch(mirror, uri, ref, local_ref)
+				commit = _commit(mirror, local_ref)
+
+			trees = mirror[:-len(".git")] + ".trees"
+			tree = join(trees, commit)
+			if isdir(tree):
+				# The modification time orders checkouts by last use
+				utime(tree, None)
+			else:
+				_git(mirror, "worktree", "prune")
+				_git(mirror, "worktree", "add", "-f", "--detach", tree, commit)
+			_prune_trees(mirror, trees, commit)
+			return tree, fetched
+		finally:
+			flock(lock, LOCK_UN)
@@ -19,37 +19,55 @@
 
 from json import dumps, loads
 from os import (makedirs, remove, symlink, getcwd, listdir, chdir, kill,
-	unlink, readlink)
+	unlink, readlink, rename, getpid)
 from os.path import (realpath, exists, isfile, isdir, join, expanduser,
 	dirname, basename, splitext, split, normpath, islink)
-from re import findall, sub
-from shutil import copyfile, copytree, rmtree
+from re import sub, compile as regex
+from shutil import copyfile, copytree, rmtree, copyfileobj
 from sys import exit
+from traceback import format_exc
+from multiprocessing import Pool
+from StringIO import StringIO
+import sys
 from time import time
-from urllib2 import urlopen, HTTPError
+from urllib2 import HTTPError
 from subprocess import call as subcall
 from datetime import datetime
+from hashlib import sha1
 
 #------------------------------
 # Third-party
 #------------------------------
 
-import coffeescript
-from BeautifulSoup import BeautifulSoup, Tag
-from coffeescript import compile as coffeecc
 from jinja2 import Template
 
-COFFEE_SCRIPT_JS = join(dirname(coffeescript.__file__), 'coffee-script.js')
-
 #------------------------------
 # Project
 #------------------------------
 
 from utilities import (mkdirp, read_file, write_file, call, merge_directories,
-	fix_path, unpackage, loc, printr, set_dir, prompt, print_directories, shrt)
+	fix_path, unpackage, loc, printr, set_dir, prompt, print_directories, shrt,
+	replace_file, UnknownArchiveException)
 from utilities import print_event as pe
 from daemon import Daemon
+from fetch import prefetch, DEFAULT_JOBS, OfflineError
+from graph import BuildGraph
+from resolver import Resolver, CycleError
+from compilers import get_compiler, DEFAULT_COMPILER
+from markup import get_markup
+from watch import watch as watch_tree
+from coffee import compile_batch, COFFEE_SCRIPT_JS
+from cache import (conditional_headers, save_validators, store, materialize,
+	content_hash, file_hash, store_blob, has_blob, restore_blob, CACHE_DIR)
+from lockfile import LockFile
+from mirror import checkout, MirrorError, MIRROR_DIR
+from archive import Archive, archive_path, ARCHIVE_DIR
+from css import rewrite_urls, map_urls, RewriteLog
+from fingerprint import AssetMap
+from compress import compress_tree, settings as compress_settings
+import fetch
 from server import simple, secure, threaded
+import eventserver
 
 #------------------------------
 #
@@ -76,11 +94,13 @@ __status__ = "Development"
 #------------------------------
 
 BUILD_TARGET = "{0}/build_targets/{1}.json"
+BUILD_GRAPH = "{0}/.ford-build/{1}-{2}.json"
+LOCK_FILE = "ford.lock"
+CSS_LOG = ".ford-build/css.json"
 USER_DIR = expanduser("~/.ford")
 SCRIPT_DIR = join(USER_DIR, "scripts")
 LOCK_DIR = join(USER_DIR, "locks")
 HOSTING_DIR = join(USER_DIR, "hosting")
-CACHE_DIR = join(USER_DIR, "cache")
 LOG_DIR = join(USER_DIR, "log")
 CENTRAL_SERVER_DIR = join(USER_DIR, "server")
 SETTINGS_FILE = join(USER_DIR, "settings.json")
@@ -144,6 +164,7 @@ PROJECT_DIRS = ["lib", "manifests"]
 
 JSPACK = "window.fordPacked=true;window.fordSrc={};"
 JS = "window.fordSrc['{0}']="
+FRD = regex(r"\$FRD(\d+)")
 
 #------------------------------
 # Update and Build
@@ -158,6 +179,7 @@ VALID_MIME = {
 	"css": ["text/plain", "text/css"],
 	"html": ["text/plain", "text/html"],
 	"zip": ["application/zip"],
+	"tar": ["application/x-tar", "application/x-gzip", "application/gzip"],
 	"images": ["image/png"]
 }
 
@@ -171,16 +193,6 @@ class JSONError(Exception):
 class UpdateError(Exception):
 	pass
 
-#------------------------------
-# Custom tags
-#------------------------------
-
-# Add tags to beautifulsoup or HTML will not build properly
-CUSTOM_TAGS = ("group", "component", "def", "sect")
-BeautifulSoup.NESTABLE_BLOCK_TAGS += CUSTOM_TAGS
-for t in CUSTOM_TAGS:
-	BeautifulSoup.NESTABLE_TAGS[t] = []
-
 #------------------------------
 #
 # Utilities
@@ -206,6 +218,7 @@ def get_settings():
 			settings = DEFAULT_SETTINGS
 			write_file(SETTINGS_FILE, dumps(DEFAULT_SETTINGS))
 	else:
+		settings = dict(DEFAULT_SETTINGS)
 		write_file(SETTINGS_FILE, dumps(settings))
 
 def setting(key, val=None):
@@ -248,11 +261,14 @@ def in_cache(lib, resource, proj, full_lib=False):
 # Generic
 #------------------------------
 
-def soup_txt(txt, path):
+def soup_txt(txt, path, markup, fragment=False):
 	index_html = None
 	try:
-		index_html = Template(txt)
-		index_html = BeautifulSoup(index_html.render())
+		index_html = Template(txt).render()
+		if fragment:
+			index_html = markup.fragment(index_html)
+		else:
+			index_html = markup.parse(index_html)
 	except UnicodeDecodeError:
 		cmd = ["grep", "--color=auto", "-P", "-n", "-3", "[\x80-\xFF]"]
 		p = shrt(path)
@@ -264,8 +280,23 @@ def soup_txt(txt, path):
 
 	return index_html
 
-def soup_file(src):
-	return soup_txt(read_file(src), src)
+def soup_file(src, markup):
+	return soup_txt(read_file(src), src, markup)
+
+def embed_files(index_page, html, files):
+	"""Writes html to index_page with files[n] streamed in for each $FRDn."""
+	tmp = "{0}.{1}.tmp".format(index_page, getpid())
+	parts = FRD.split(html)
+	with open(tmp, "w") as out:
+		for i, part in enumerate(parts):
+			if i % 2 == 0:
+				out.write(part)
+			elif int(part) < len(files):
+				with open(files[int(part)]) as src:
+					copyfileobj(src, out)
+			else:
+				out.write("$FRD" + part)
+	rename(tmp, index_page)
 
 def expand_namespace(shorthand, obj):
 	for i in shorthand[1]:
@@ -375,24 +406,87 @@ def split_uri(uri):
 		uri = realpath(expanduser(uri))
 	return protocol, uri
 
+def resolve_pointer(resource, protocol, uri, fp):
+	"""Applies a comp file pointer, which may itself be a url, to a uri."""
+	if fp is not None:
+		# Append resource name if the pointer ends with a slash
+		if fp[-1] == "/":
+			fp += resource
+		fprotocol, fpuri = split_uri(fp)
+		if fprotocol in ["http", "https"]:
+			return fprotocol, fpuri, None
+	return protocol, uri, fp
+
+def resource_uri(uri, ftype, fp=None):
+	"""Joins a file pointer onto a uri, ensuring it ends with the ftype."""
+	if fp is not None:
+		uri = "/".join([uri, fp])
+	if ftype != "images":
+		uroot, uext = splitext(uri)
+		expect = ".{0}".format(ftype)
+		if uext != expect:
+			uri += expect
+	return uri
+
 def mime_valid(expected, ftype):
 	for mime in VALID_MIME[ftype]:
 		if mime in expected:
 			return True
 	return False
 
-wget_cache = {}
-def wget(url, ftype, dest):
-	try:
-		pe("wget", url, dest)
-		resp = urlopen(url)
-		headers = resp.headers
-		if not mime_valid(headers["content-type"], ftype):
-			raise UpdateError(loc["exception"]["invalid_mime"].format(url,
-					", ".join(VALID_MIME[ftype])))
-		write_file(dest, resp.read())
-	except HTTPError as e:
-		raise UpdateError(loc["exception"]["http"].format(str(e), url))
+def report_connections():
+	if fetch.pool.opened > 0:
+		pe("connections", fetch.pool.opened, fetch.pool.reused)
+
+def wget(url, ftype, dest, cached=False):
+	"""Downloads a url to dest; cached files are revalidated and stored.
+
+	The body is streamed to dest.part and renamed into place once it is
+	complete. An interrupted download leaves the .part behind, and the
+	next attempt asks only for the rest of it, if it has not changed.
+	"""
+	req_headers = None
+	if cached:
+		req_headers = conditional_headers(dest)
+	if fetch.offline:
+		raise OfflineError(url)
+	part = fetch.Download(dest + ".part")
+	pe("wget", url, dest)
+	resume = part.offset() > 0
+	if resume and part.validator() is None:
+		# Without a validator a changed file would be spliced onto the old
+		part.discard()
+		resume = False
+	while True:
+		headers = dict(req_headers or {})
+		if resume:
+			# A changed file comes back whole instead of as a range
+			headers["Range"] = "bytes={0}-".format(part.offset())
+			headers["If-Range"] = part.validator()
+		try:
+			status, resp_headers, data = fetch.get(url, headers or None, part)
+			break
+		except HTTPError as e:
+			# The .part is stale, or all there is; start over
+			if e.code == 416 and resume:
+				part.discard()
+				resume = False
+				continue
+			raise UpdateError(loc["exception"]["http"].format(str(e), url))
+
+	if status == 304:
+		part.discard()
+		pe("unchanged", dest)
+		return False
+	if not mime_valid(resp_headers["content-type"], ftype):
+		part.discard()
+		raise UpdateError(loc["exception"]["invalid_mime"].format(url,
+				", ".join(VALID_MIME[ftype])))
+	part.finish(dest)
+	if cached:
+		save_validators(dest, resp_headers, part.digest())
+		store(dest, part.digest())
+	return True
 
 # Author: Cimarron Taylor
 # Date: July 6, 2003
@@ -506,6 +600,33 @@ class ComboDaemon(ServerDaemon):
 		threaded(self.port, self.path)
 		secure()
 
+class EventDaemon(ServerDaemon):
+	"""Serves HTTP, and HTTPS when secure, from one event loop."""
+
+	def __init__(self, pid, port, path, secure=False):
+		super(EventDaemon, self).__init__(pid, port, path)
+		self.secure = secure
+
+	def run(self):
+		chdir(self.path)
+		listeners = []
+		if self.port != 443:
+			listeners.append((self.port, None))
+		if self.secure or self.port == 443:
+			listeners.append((443, CERT_FILE))
+		eventserver.serve(listeners, **event_limits())
+
+def event_limits():
+	"""Reads the event server's limits from the settings."""
+	limits = {}
+	for key, name in [("max_connections", "max_connections"),
+			("keepalive_timeout", "keepalive_timeout"),
+			("server_workers", "workers")]:
+		val = setting(key)
+		if val is not None:
+			limits[name] = int(val)
+	return limits
+
 def hosting_cmd(port, is_daemon=False, proj_dir=None, pid=None):
 	if proj_dir is None:
 		proj_dir = CENTRAL_SERVER_DIR
@@ -524,12 +645,16 @@ def hosting_cmd(port, is_daemon=False, proj_dir=None, pid=None):
 
 	if port == 443:
 		require_cert()
-		if is_daemon:
+		if is_daemon and setting("event_server"):
+			cmd = EventDaemon(pid, 443, proj_dir)
+		elif is_daemon:
 			cmd = SecureDaemon(pid, 443, proj_dir)
 		else:
 			cmd = ["ssl_server_ford"]
 	else:
-		if is_daemon:
+		if is_daemon and setting("event_server"):
+			cmd = EventDaemon(pid, port, proj_dir)
+		elif is_daemon:
 			cmd = ServerDaemon(pid, port, proj_dir)
 		else:
 			cmd = ["server_ford", str(port)]
@@ -568,6 +693,8 @@ def srv_status(silent=False):
 			host_txt = "SSL (443)"
 		else:
 			host_txt = "HTTP ({0})".format(port)
+		if setting("event_server"):
+			host_txt += " from one event loop"
 
 		if isfile(pidfile):
 			pid = read_file(pidfile)
@@ -643,8 +770,11 @@ def multihost(port=8080):
 	try:
 		port_file = join(HOSTING_DIR, ".ford.central-server.port")
 		proj_dir, x = hosting_cmd(port, True)
-		cmd = ComboDaemon(join(HOSTING_DIR, ".ford.central-server.pid"), port,
-				proj_dir)
+		pid = join(HOSTING_DIR, ".ford.central-server.pid")
+		if setting("event_server"):
+			cmd = EventDaemon(pid, port, proj_dir, True)
+		else:
+			cmd = ComboDaemon(pid, port, proj_dir)
 
 		write_file(port_file, str(port))
 		cmd.restart()
@@ -757,27 +887,21 @@ def cdnimport(force):
 		pe("notice", "import", "nothing")
 	else:
 		pe("success", "import")
+	report_connections()
 
 #------------------------------
 # HTML
 #------------------------------
 
-def replace_element(element, replacement=None):
+def replace_element(markup, element, replacement=None):
 	if replacement is not None:
-		element.replaceWith(replacement)
+		markup.replace(element, replacement)
 	else:
-		element.extract()
-
-def merge_classes(element, target):
-	if not "class" in element:
-		return
+		markup.extract(element)
 
-	classes = element["class"].split()
-
-	if not "class" in target:
-		tClasses = []
-	else:
-		tClasses = target["class"].split()
+def merge_classes(markup, element, target):
+	classes = (markup.get(element, "class") or "").split()
+	tClasses = (markup.get(target, "class") or "").split()
 
 	add = []
 	for cName in classes:
@@ -786,25 +910,69 @@ def merge_classes(element, target):
 		if not cName in tClasses:
 			add.append(cName)
 	if len(add):
-		target["class"] = " ".join(add)
+		markup.set(target, "class", " ".join(tClasses + add))
 
-def merge_sections(element, target):
+def merge_sections(markup, element, target):
 	smap = {}
-	sections = element.findAll("def")
-	tSections = target.findAll("sect")
+	sections = markup.find_all(element, "def")
+	tSections = markup.find_all(target, "sect")
 
 	for section in sections:
-		smap[section["class"]] = section.renderContents()
+		smap[markup.get(section, "class")] = section
 
 	for tSection in tSections:
-		replacement = None
-		if tSection["class"] in smap:
-			replacement = smap[tSection["class"]]
-		replace_element(tSection, replacement)
+		cls = markup.get(tSection, "class")
+		if cls in smap:
+			for child in markup.contents(smap[cls]):
+				markup.insert_before(tSection, markup.clone(child))
+		replace_element(markup, tSection)
 
 def lib_path(lib):
 	return "lib/{0}".format(lib)
 
+#------------------------------
+# Parallel build targets
+#------------------------------
+
+# Workers are forked from the building process and find its project here
+parallel_project = None
+
+def build_target(target):
+	"""Builds a target in a worker, returning whether it passed and its log."""
+	proj = parallel_project
+	proj.worker = True
+	stdout = sys.stdout
+	sys.stdout = StringIO()
+	ok = True
+	try:
+		try:
+			proj._build_target(target, False)
+		except SystemExit as e:
+			ok = not e.code
+		except (JSONError, UpdateError):
+			# These have reported themselves already
+			ok = False
+		except Exception:
+			print format_exc()
+			ok = False
+		return (target, ok, sys.stdout.getvalue())
+	finally:
+		sys.stdout = stdout
+
+def build_chain(targets):
+	"""Builds targets one after another in a worker, stopping at a failure."""
+	results = []
+	for target in targets:
+		results.append(build_target(target))
+		if not results[-1][1]:
+			break
+	return results
+
+def overlaps(a, b):
+	"""Whether two output paths are the same, or one is inside the other."""
+	a, b = normpath(a), normpath(b)
+	return a == b or a.startswith(b + "/") or b.startswith(a + "/")
+
 #------------------------------
 #
 # Upgrade
@@ -859,6 +1027,7 @@ def upgrade(force=False):
 		pe("notice", "upgrade", "nothing")
 	else:
 		pe("success", "upgrade")
+	report_connections()
 
 #------------------------------
 #
@@ -882,12 +1051,11 @@ class Project(object):
 		self.lock_file = join(LOCK_DIR, "{0}.lock".format(self.project_name))
 		self.output_dir = None
 		self.libraries = {}
-		self.included = {}
-		self.unpacked = {}
-		self.held_resources = {}
+		self.archives = {}
 		self.tmp_paths = {}
-		self.pending_resources = 0
 		self.namebust = False
+		self.fingerprint = False
+		self.assets = None
 		self.content = None
 		self.manifest = None
 		self.build_project = False
@@ -896,7 +1064,25 @@ class Project(object):
 		self.update_cache = False
 		self.rawsrc = False
 		self.update_project = True
+		self.fetch_jobs = None
+		self.incremental = True
+		self.compiler = None
+		self.html_parser = None
+		self.build_jobs = 1
+		self.dep_lock = None
+		self.relock = False
+		self.offline = False
+		self.missing = []
+		self.css_log = None
+		self.worker = False
+		self.graph = None
+		self.graphs = {}
+		self.shared_assets = set()
+		self.pending_coffee = []
+		self.graph_inputs = []
+		self.updated_libs = []
 		self.cut_outs = []
+		self.component_templates = {}
 
 		# For output formatting
 		set_dir(self.project_dir)
@@ -921,10 +1107,32 @@ class Project(object):
 			return (True, message)
 
 	def unlock(self):
-		remove(self.lock_file)
+		if isfile(self.lock_file):
+			remove(self.lock_file)
+
+	def watch(self, out_dir, embed, rawsrc, namebust):
+		"""Builds the project, then rebuilds it whenever a file changes."""
+		lock_message = read_file(self.lock_file)
+
+		def rebuild():
+			try:
+				self.build(out_dir, False, embed, rawsrc, False, namebust)
+				return True
+			except (SystemExit, JSONError, UpdateError):
+				# A failed build unlocks the project; keep it ours
+				if not isfile(self.lock_file):
+					write_file(self.lock_file, lock_message)
+				return False
+
+		# What the build itself writes must not start another build
+		watch_tree(self.project_dir, rebuild, [out_dir,
+				join(self.project_dir, "lib"),
+				join(self.project_dir, LOCK_FILE)])
 
 	def exit(self, code):
-		self.unlock()
+		# Workers leave the lock to the process that took it
+		if not self.worker:
+			self.unlock()
 		exit(code)
 
 	def _prepare(self):
@@ -932,11 +1140,11 @@ class Project(object):
 		lib_groups = {}
 		self.content = {"html": {}, "css": [], "js": []}
 		self.libraries = {}
-		self.included = {}
-		self.unpacked = {}
-		self.held_resources = {}
+		self.archives = {}
 		self.tmp_paths = {}
-		self.pending_resources = 0
+		self.graph_inputs = []
+		self.updated_libs = []
+		self.pending_coffee = []
 		self.cut_outs = []
 
 		if "cut_out" in self.manifest:
@@ -952,26 +1160,95 @@ class Project(object):
 			return False
 		return self.manifest[name]
 
-	def _compile(self, ftype, name):
-		if call(["which", "juicer"]) != 0:
-			printr("[ ERROR ] juicer is not installed!", "red")
+	def _coffeecc(self, sources, paths):
+		"""Compiles CoffeeScript sources together, exiting on any errors."""
+		cache_dir = None
+		if self.from_cache:
+			cache_dir = join(CACHE_DIR, ".coffee")
+		results = compile_batch(sources, cache_dir)
+
+		failed = False
+		for path, (js, err) in zip(paths, results):
+			if err is not None:
+				pe("exception", "coffee", path, err)
+				failed = True
+		if failed:
 			self.exit(1)
+		return [js for js, err in results]
 
-		cmd = ["juicer", "merge", "--force", "--document-root",
-				"'{0}'".format(self.project_dir)]
+	def _compile_pending_coffee(self):
+		if not len(self.pending_coffee):
+			return
+		srcs = [src for src, dest in self.pending_coffee]
+		compiled = self._coffeecc([read_file(src) for src in srcs], srcs)
+		for (src, dest), js in zip(self.pending_coffee, compiled):
+			# Parallel build targets may share compiled files
+			replace_file(dest, js)
+			self._record(dest, [src], None, [dest])
+		self.pending_coffee = []
+
+	def _load_graph(self):
+		# Time based names change every build, so nothing is ever current
+		if not self.incremental or self.namebust:
+			return None
+		key = sha1("|".join([self.current_manifest, self.output_dir]))
+		name = splitext(basename(self.current_manifest))[0]
+		path = BUILD_GRAPH.format(self.project_dir, name, key.hexdigest()[:8])
+		# Resident projects (ford watch) keep their graphs between builds
+		if not path in self.graphs:
+			self.graphs[path] = BuildGraph(path)
+		return self.graphs[path]
+
+	def _fresh(self, step, inputs=None, values=None):
+		if self.graph is None or not self.graph.fresh(step, inputs, values):
+			return False
+		pe("uptodate", step)
+		return True
+
+	def _record(self, step, inputs, values, outputs):
+		if self.graph is not None:
+			self.graph.record(step, inputs, values, outputs)
+
+	def _bundle_inputs(self, ftype):
+		inputs = [self.current_manifest]
+		for p in self.content[ftype]:
+			if p not in self.cut_outs:
+				part = join(self.project_dir, p)
+				inputs.append(part)
+				# Stylesheets embed the images next to them as data uris
+				images = join(dirname(part), "images")
+				if ftype == "css" and isdir(images):
+					inputs += self.graph.tree(images)
+		return inputs
+
+	def _compiler_name(self):
+		name = self.compiler
+		if "compiler" in self.manifest:
+			name = self.manifest["compiler"]
+		return name or DEFAULT_COMPILER
+
+	def _compiler(self):
+		name = self._compiler_name()
+		cache_dir = None
+		if self.from_cache:
+			cache_dir = join(CACHE_DIR, ".minified")
+		try:
+			compiler = get_compiler(name, cache_dir)
+		except KeyError:
+			printr("[ ERROR ] {0} is not a known compiler!".format(name), "red")
+			self.exit(1)
+		if not compiler.available():
+			printr("[ ERROR ] {0} is not installed!".format(name), "red")
+			self.exit(1)
+		return compiler
+
+	def _compile(self, ftype, name):
 		src_file = "{0}/{2}.{1}".format(self.output_dir, ftype, name)
 		out_file = "{0}/{2}.min.{1}".format(self.output_dir, ftype, name)
-		if ftype == "js":
-			cmd += ["--skip-verification"]
-			if self._manifest_flag("rawsrc") or self.rawsrc:
-				cmd += ['--minifyer ""']
-		elif ftype == "css":
-			cmd += ["--force-image-embed", "--embed-images", "data_uri"]
-		cmd += ["'{0}'".format(src_file)]
-		resp = call(cmd, sout=True)
-
-		# Juicer doesn't fail on failure; test for such cases
-		is_error = "[ERROR]" in resp or "Errno::ENOENT" in resp
+		minify = not (self._manifest_flag("rawsrc") or self.rawsrc)
+		is_ok, resp = self._compiler().merge(ftype, src_file, out_file,
+				self.project_dir, minify)
+		is_error = not is_ok
 		print resp
 
 		if not is_error:
@@ -992,8 +1269,23 @@ class Project(object):
 			print resp
 			self.exit(1)
 
-	def _expand_component_group(self, component):
-		cid = component["id"]
+	def _markup(self):
+		name = self.html_parser
+		if "html_parser" in self.manifest:
+			name = self.manifest["html_parser"]
+		try:
+			markup = get_markup(name)
+		except KeyError:
+			printr("[ ERROR ] {0} is not a known HTML parser!".format(name),
+					"red")
+			self.exit(1)
+		if not markup.available():
+			printr("[ ERROR ] {0} is not installed!".format(name), "red")
+			self.exit(1)
+		return markup
+
+	def _expand_component_group(self, m, component):
+		cid = m.get(component, "id")
 		parts = cid.split("@")
 		lib = parts.pop(0)
 		group = "-".join(parts)
@@ -1009,15 +1301,29 @@ class Project(object):
 			exit(1)
 
 		resources = groups[group]
-		index_idx = component.parent.contents.index(component)
+		inserted = []
 		for resource in resources:
-			tpl = '<component id="{0}-{1}"></component>'.format(lib, resource)
-			component.parent.insert(index_idx + 1, BeautifulSoup(tpl))
-
-		replace_element(component)
-
-	def _insert_component(self, component):
-		cid = component["id"]
+			tpl = m.element("component",
+					[("id", "{0}-{1}".format(lib, resource))])
+			m.insert_after(component, tpl)
+			inserted.append(tpl)
+
+		replace_element(m, component)
+		return inserted
+
+	def _component_template(self, m, lib, resource):
+		# Templates are rendered and parsed once, then cloned for each use
+		txt = self.content["html"][lib][resource]
+		key = (m.name, lib, resource)
+		cached = self.component_templates.get(key)
+		if cached is None or cached[0] != txt:
+			path = self.mkpath(lib, resource, "html")
+			cached = (txt, soup_txt(txt, path, m, True))
+			self.component_templates[key] = cached
+		return cached[1]
+
+	def _insert_component(self, m, component):
+		cid = m.get(component, "id")
 		parts = cid.split("-")
 		lib = parts.pop(0)
 		resource = "-".join(parts)
@@ -1029,39 +1335,201 @@ class Project(object):
 			pe("exception", "missing_property", resource, html[lib].keys())
 			exit(1)
 
-		element = soup_txt(html[lib][resource],
-				self.mkpath(lib, resource, "html"))
-		merge_classes(component, element)
-		merge_sections(component, element)
-		replace_element(component, element)
-
-	def _resolve_component_html(self, doc):
-		groups = doc.findAll("group")
-		for g in groups:
-			self._expand_component_group(g)
-		doc = BeautifulSoup(str(doc))
-
-		components = doc.findAll("component")
-		for c in components:
-			self._insert_component(c)
-		doc = BeautifulSoup(str(doc))
-		if len(doc.findAll("component")) > 0 or len(doc.findAll("group")) > 0:
-			doc = self._resolve_component_html(doc)
+		element = m.clone(self._component_template(m, lib, resource))
+		merge_classes(m, component, element)
+		merge_sections(m, component, element)
+
+		inserted = m.contents(element)
+		for child in inserted:
+			m.insert_before(component, child)
+		replace_element(m, component)
+		return inserted
+
+	def _resolve_component_html(self, m, doc):
+		# Expand groups and components in a single walk of the document;
+		# whatever an expansion inserts is walked in turn, so nested
+		# components resolve without parsing the document again.
+		stack = [doc]
+		while len(stack):
+			node = stack.pop()
+			if not m.is_element(node):
+				continue
+			if m.tag(node) == "group":
+				inserted = self._expand_component_group(m, node)
+			elif m.tag(node) == "component":
+				inserted = self._insert_component(m, node)
+			else:
+				inserted = m.children(node)
+			stack.extend(reversed(inserted))
 		return doc
 
 	def _complete(self):
 		pe("action", "build", self.current_manifest)
 
-		js_path, css_path, html_path = [None] * 3
-		if self.namebust:
+		fingerprint = self._manifest_flag("fingerprint") or self.fingerprint
+		if self.namebust and not fingerprint:
 			default_name = str(time())
 		else:
 			default_name = "application"
 
+		jsn, csn, htn, js_path, css_path, html_path = \
+				self._output_names(default_name)
+		path = "{0}/application".format(self.output_dir)
+
+		has_css, has_js = False, False
+		bundles = []
+		if css_path is not None:
+			path = css_path
+		rawsrc = self._manifest_flag("rawsrc") or self.rawsrc
+		if len(self.content["css"]):
+			css = []
+			fp = "{0}.css".format(path)
+			out = fp if rawsrc else "{0}.min.css".format(path)
+			inputs = None
+			values = {"rawsrc": rawsrc, "compiler": self._compiler_name()}
+			if self.graph is not None:
+				inputs = self._bundle_inputs("css")
+			if not self._fresh(out, inputs, values):
+				pe("compiling", fp)
+				for p in self.content["css"]:
+					part = "{0}/{1}".format(self.project_dir, p)
+					if p not in self.cut_outs:
+						pe("parts", part)
+						css.append("@import url(/{1})".format(self.project_dir,
+								p))
+					else:
+						pe("ignored", part)
+				write_file(fp, "\n".join(css) + "\n")
+				self._compile("css", csn)
+				if inputs is not None:
+					self._record(out, inputs, values, [out])
+			bundles.append(out)
+			has_css = True
+
+		if js_path is not None:
+			path = js_path
+		if len(self.content["js"]):
+			js = []
+			fp = "{0}.js".format(path)
+			out = fp if rawsrc else "{0}.min.js".format(path)
+			inputs = None
+			values = {"rawsrc": rawsrc, "compiler": self._compiler_name()}
+			if self.graph is not None:
+				inputs = self._bundle_inputs("js")
+			if not self._fresh(out, inputs, values):
+				pe("compiling", fp)
+				for p in self.content["js"]:
+					part = "{0}/{1}".format(self.project_dir, p)
+					if p not in self.cut_outs:
+						pe("parts", part)
+						js.append(" * @depends /{1}".format(self.project_dir, p))
+					else:
+						pe("ignored", part)
+				content = "/**\n{0}\n */\n".format("\n".join(js))
+				write_file(fp, content)
+				self._compile("js", jsn)
+				if inputs is not None:
+					self._record(out, inputs, values, [out])
+			bundles.append(out)
+			has_js = True
+
+		if html_path is not None:
+			path = html_path
+
+		build_index = self._builds_index()
+		is_lib_build = "library" in self.manifest
+
+		for asset in self._asset_copies(build_index):
+			# Copied once by the building process for every parallel target
+			if asset not in self.shared_assets:
+				self._include_asset(*asset)
+
+		self.assets = None
+		if fingerprint:
+			self.assets = self._fingerprint(bundles)
+
+		if build_index:
+			index = "{{0}}/{0}.html".format(htn)
+			src = index.format(self.project_dir)
+			if not exists(src):
+				pe("exception", "missing_file", src)
+				exit(1)
+
+			index_page = index.format(self.output_dir)
+			use_single = self._manifest_flag("embed") or self.single_file
+			inputs = None
+			values = {
+				"embed": use_single,
+				"rawsrc": rawsrc,
+				"html_parser": self.html_parser,
+				"html": sha1(dumps(self.content["html"], sort_keys=True))
+						.hexdigest(),
+				"assets": self.assets
+			}
+			if self.graph is not None:
+				inputs = [self.current_manifest, src] + bundles
+				if use_single and "package_scripts" in self.manifest:
+					for f in self.manifest["package_scripts"]:
+						inputs.append(join(self.output_dir, f))
+			if not self._fresh(index_page, inputs, values):
+				self._render_index(src, index_page, htn, jsn, csn, path,
+						has_js, has_css)
+				if inputs is not None:
+					self._record(index_page, inputs, values, [index_page])
+			else:
+				pe("success", "application", index_page)
+		elif is_lib_build:
+			pe("success", "lib", self.current_manifest)
+		else:
+			pe("success", "builder", self.current_manifest)
+
+		# Parallel targets share the output; the building process compresses
+		if not self.worker:
+			self._compress(self.manifest.get("compress"))
+
+	def _include_asset(self, fd, flatten=False, is_file=False):
+		src = "{{0}}/{0}".format(fd)
+		if flatten:
+			dest = "{{0}}/{0}".format(basename(fd))
+		else:
+			dest = src
+
+		if exists(src.format(self.project_dir)):
+			step = dest.format(self.output_dir)
+			inputs = None
+			if self.graph is not None:
+				inputs = self.graph.tree(src.format(self.project_dir))
+			if self._fresh(step, inputs):
+				return
+			if exists(dest.format(self.output_dir)):
+				if is_file:
+					remove(dest.format(self.output_dir))
+				else:
+					rmtree(dest.format(self.output_dir))
+			pe("asset", src.format(self.project_dir),
+					dest.format(self.output_dir))
+			if is_file:
+				copyfile(src.format(self.project_dir),
+						dest.format(self.output_dir))
+			else:
+				copytree(src.format(self.project_dir),
+						dest.format(self.output_dir))
+			if inputs is not None:
+				self._record(step, inputs, None, self.graph.tree(step))
+
+	def _compress(self, option):
+		compress = compress_settings(option)
+		if compress is not None:
+			written = compress_tree(self.output_dir, *compress)
+			if written:
+				pe("compressed", written, self.output_dir)
+
+	def _output_names(self, default_name):
+		"""Returns the js, css and html names and paths of the manifest."""
+		js_path, css_path, html_path = [None] * 3
 		jsn, csn = [default_name] * 2
 
 		htn = "index"
-		path = "{0}/application".format(self.output_dir)
 		if "output" in self.manifest:
 			op = self.manifest["output"]
 			if not (isinstance(op, basestring) or isinstance(op, str)):
@@ -1080,94 +1548,25 @@ class Project(object):
 		else:
 			js_path = "{0}/{1}".format(self.output_dir, jsn)
 			css_path = "{0}/{1}".format(self.output_dir, csn)
+		return jsn, csn, htn, js_path, css_path, html_path
 
-		has_css, has_js = False, False
-		if css_path is not None:
-			path = css_path
-		if len(self.content["css"]):
-			css = []
-			fp = "{0}.css".format(path)
-			pe("compiling", fp)
-			for p in self.content["css"]:
-				part = "{0}/{1}".format(self.project_dir, p)
-				if p not in self.cut_outs:
-					pe("parts", part)
-					css.append("@import url(/{1})".format(self.project_dir, p))
-				else:
-					pe("ignored", part)
-			write_file(fp, "\n".join(css) + "\n")
-			self._compile("css", csn)
-			has_css = True
-
-		if js_path is not None:
-			path = js_path
-		if len(self.content["js"]):
-			js = []
-			fp = "{0}.js".format(path)
-			pe("compiling", fp)
-			for p in self.content["js"]:
-				part = "{0}/{1}".format(self.project_dir, p)
-				if p not in self.cut_outs:
-					pe("parts", part)
-					js.append(" * @depends /{1}".format(self.project_dir, p))
-				else:
-					pe("ignored", part)
-			content = "/**\n{0}\n */\n".format("\n".join(js))
-			write_file(fp, content)
-			self._compile("js", jsn)
-			has_js = True
-
-		if html_path is not None:
-			path = html_path
-
+	def _builds_index(self):
 		build_index = True
-		is_lib_build = False
 		if "library" in self.manifest:
 			build_index = not self.manifest["library"]
-			is_lib_build = True
 		if "only_build_targets" in self.manifest:
 			if self.manifest["only_build_targets"]:
 				build_index = False
+		return build_index
 
-		def include_asset(fd, flatten=False, is_file=False):
-			src = "{{0}}/{0}".format(fd)
-			if flatten:
-				dest = "{{0}}/{0}".format(basename(fd))
-			else:
-				dest = src
-
-			if exists(src.format(self.project_dir)):
-				if exists(dest.format(self.output_dir)):
-					if is_file:
-						remove(dest.format(self.output_dir))
-					else:
-						rmtree(dest.format(self.output_dir))
-				pe("asset", src.format(self.project_dir),
-						dest.format(self.output_dir))
-				if is_file:
-					copyfile(src.format(self.project_dir),
-							dest.format(self.output_dir))
-				else:
-					copytree(src.format(self.project_dir),
-							dest.format(self.output_dir))
-
-		dirs_to_copy = []
-		if "directories" in self.manifest:
-			dirs_to_copy = self.manifest["directories"]
+	def _asset_copies(self, build_index):
+		"""Lists the (path, flatten, is_file) of each asset to copy."""
+		dirs_to_copy = list(self.manifest.get("directories", []))
 		if build_index:
 			dirs_to_copy.append("localization")
-
-		flat_dirs_to_copy = []
-		if "directories_flat" in self.manifest:
-			flat_dirs_to_copy = self.manifest["directories_flat"]
-
-		files_to_copy = []
-		if "files" in self.manifest:
-			files_to_copy = self.manifest["files"]
-
-		flat_files_to_copy = []
-		if "files_flat" in self.manifest:
-			flat_files_to_copy = self.manifest["files_flat"]
+		flat_dirs_to_copy = list(self.manifest.get("directories_flat", []))
+		files_to_copy = list(self.manifest.get("files", []))
+		flat_files_to_copy = list(self.manifest.get("files_flat", []))
 
 		if "directory_contents" in self.manifest:
 			for d in self.manifest["directory_contents"]:
@@ -1181,138 +1580,140 @@ class Project(object):
 						elif isdir(fp):
 							flat_dirs_to_copy.append(fpc)
 
-		for d in dirs_to_copy:
-			include_asset(d)
-
-		for fd in flat_dirs_to_copy:
-			include_asset(fd, True)
-
-		for f in files_to_copy:
-			include_asset(f, is_file=True)
-
-		for ff in flat_files_to_copy:
-			include_asset(ff, True, True)
-
-		if build_index:
-			index = "{{0}}/{0}.html".format(htn)
-			src = index.format(self.project_dir)
-			if not exists(src):
-				pe("exception", "missing_file", src)
-				exit(1)
+		return [(d, False, False) for d in dirs_to_copy] + \
+				[(fd, True, False) for fd in flat_dirs_to_copy] + \
+				[(f, False, True) for f in files_to_copy] + \
+				[(ff, True, True) for ff in flat_files_to_copy]
+
+	def _fingerprint(self, bundles):
+		"""Publishes the bundles, and the files their CSS uses, by hash."""
+		assets = AssetMap(self.output_dir)
+
+		for out in bundles:
+			data = None
+			if out.endswith(".css"):
+				def asset(u, base=dirname(out)):
+					path = u.split("?")[0].split("#")[0]
+					if "://" in path or path.startswith("//"):
+						return None
+					if path.startswith("/"):
+						fp = join(self.output_dir, path[1:])
+					else:
+						fp = join(base, path)
+					if not isfile(fp) or assets.name(fp) is None:
+						return None
+					name = basename(assets.add(fp))
+					return path[:-len(basename(path))] + name + u[len(path):]
+				data = map_urls(read_file(out), asset)
+			assets.add(out, data)
+		assets.save()
+		return assets.names
+
+	def _render_index(self, src, index_page, htn, jsn, csn, path, has_js,
+			has_css):
+		m = self._markup()
+
+		# Treat our HTML as a Jinja2 template
+		index_html = soup_file(src, m)
+
+		# process inline coffeescript tags
+		cscripts = m.find_all(index_html, type="text/coffeescript")
+		compiled = self._coffeecc([m.text(c) for c in cscripts],
+				[src] * len(cscripts))
+		for cscript, js in zip(cscripts, compiled):
+			script = m.element("script", [("type", "text/javascript")])
+			m.set_text(script, js)
+			replace_element(m, cscript, script)
+
+		bootstrap = m.find_all(index_html, id="bootstrap")
+		if len(bootstrap) == 0:
+			pe("exception", "missing_tag", "bootstrap",
+					"{0}.html".format(htn))
+			exit(1)
+		bootstrap = bootstrap[0]
 
-			# Treat our HTML as a Jinja2 template
-			index_html = soup_file(src)
-
-			# process inline coffeescript tags
-			cscripts = index_html.findAll(type="text/coffeescript")
-			for cscript in cscripts:
-				script = Tag(index_html, "script")
-				script["type"] = "text/javascript"
-				script.string = coffeecc(cscript.string)
-				cscript.replaceWith(script)
-			index_html = BeautifulSoup(str(index_html))
-
-			bootstrap = index_html.findAll(id="bootstrap")
-			if len(bootstrap) == 0:
-				pe("exception", "missing_tag", "bootstrap",
-						"{0}.html".format(htn))
-				exit(1)
-			bootstrap = bootstrap[0]
-			index_idx = bootstrap.parent.contents.index(bootstrap)
+		use_single = self._manifest_flag("embed") or self.single_file
+		rp = []
 
-			use_single = self._manifest_flag("embed") or self.single_file
-			rp = []
+		cb = str(time())
 
-			index_page = index.format(self.output_dir)
-			cb = str(time())
-
-			if has_js:
-				script = Tag(index_html, "script")
-				script["type"] = "text/javascript"
-				if use_single:
-					script.append("$FRD" + str(len(rp)))
-					if self._manifest_flag("rawsrc") or self.rawsrc:
-						d = "{0}.js".format(path)
-					else:
-						d = "{0}.min.js".format(path)
-					rp.append(read_file(d))
-					pe("embed", d, index_page)
-				elif self._manifest_flag("rawsrc") or self.rawsrc:
-					script["src"] = "{0}.js".format(jsn)
-					if not self.namebust:
-						script["src"] += "?_={0}".format(cb)
+		if has_js:
+			script = m.element("script", [("type", "text/javascript")])
+			if use_single:
+				m.set_text(script, "$FRD" + str(len(rp)))
+				if self._manifest_flag("rawsrc") or self.rawsrc:
+					d = "{0}.js".format(path)
 				else:
-					script["src"] = "{0}.min.js".format(jsn)
-					if not self.namebust:
-						script["src"] += "?_={0}".format(cb)
-				bootstrap.parent.insert(index_idx + 1, script)
-
-			# Package the scripts first, cause we prepend the js def later
-			if use_single and "package_scripts" in self.manifest:
-				bootstrap.parent.insert(index_idx + 1, script)
-				for f in self.manifest["package_scripts"]:
-					fpath = join(self.output_dir, f)
-					if isfile(fpath):
-						script = Tag(index_html, "script")
-						script["type"] = "text/javascript"
-						script.append(JS.format(f) +
-							"$FRD" + str(len(rp)) + ";")
-						bootstrap.parent.insert(index_idx + 1, script)
-						rp.append(read_file(fpath))
-						pe("embed", fpath, index_page)
-
-				# Insert preface tag with defs to prepare the package.
-				script = Tag(index_html, "script")
-				script["type"] = "text/javascript"
-				script.append(JSPACK)
-				bootstrap.parent.insert(index_idx + 1, script)
-
-			if has_css:
-				if use_single:
-					if self._manifest_flag("rawsrc") or self.rawsrc:
-						d = "{0}.css".format(path)
-					else:
-						d = "{0}.min.css".format(path)
-					style = Tag(index_html, "style")
-					style["media"] = "screen, print"
-					style["type"] = "text/css"
-					style.string = read_file(d)
-					pe("embed", d, index_page)
+					d = "{0}.min.js".format(path)
+				rp.append(d)
+				pe("embed", d, index_page)
+			else:
+				if self._manifest_flag("rawsrc") or self.rawsrc:
+					src_attr = "{0}.js".format(jsn)
 				else:
-					style = Tag(index_html, "link")
-					style["media"] = "screen, print"
-					style["rel"] = "stylesheet"
-					style["type"] = "text/css"
-					if self._manifest_flag("rawsrc") or self.rawsrc:
-						style["href"] = "{0}.css".format(csn)
-						if not self.namebust:
-							style["href"] += "?_={0}".format(cb)
-					else:
-						style["href"] = "{0}.min.css".format(csn)
-						if not self.namebust:
-							style["href"] += "?_={0}".format(cb)
-				bootstrap.parent.insert(index_idx + 1, style)
-
-			# Remove the bootstrap tag
-			bootstrap.extract()
-
-			# Handle component HTML
-			index_html = self._resolve_component_html(index_html)
-			write_file(index.format(self.output_dir), str(index_html))
-			pe("success", "application", index_page)
-
-			# Beautifulsoup doesn't do well with this
-			if len(rp):
-				fdata = read_file(index.format(self.output_dir))
-				idx = 0
-				for repl in rp:
-					fdata = fdata.replace("$FRD" + str(idx), repl)
-					idx += 1
-				write_file(index.format(self.output_dir), fdata)
-		elif is_lib_build:
-			pe("success", "lib", self.current_manifest)
+					src_attr = "{0}.min.js".format(jsn)
+				if self.assets is not None:
+					src_attr = self.assets.get(src_attr, src_attr)
+				elif not self.namebust:
+					src_attr += "?_={0}".format(cb)
+				m.set(script, "src", src_attr)
+			m.insert_after(bootstrap, script)
+
+		# Package the scripts first, cause we prepend the js def later
+		if use_single and "package_scripts" in self.manifest:
+			m.insert_after(bootstrap, script)
+			for f in self.manifest["package_scripts"]:
+				fpath = join(self.output_dir, f)
+				if isfile(fpath):
+					script = m.element("script", [("type", "text/javascript")])
+					m.set_text(script, JS.format(f) +
+						"$FRD" + str(len(rp)) + ";")
+					m.insert_after(bootstrap, script)
+					rp.append(fpath)
+					pe("embed", fpath, index_page)
+
+			# Insert preface tag with defs to prepare the package.
+			script = m.element("script", [("type", "text/javascript")])
+			m.set_text(script, JSPACK)
+			m.insert_after(bootstrap, script)
+
+		if has_css:
+			if use_single:
+				if self._manifest_flag("rawsrc") or self.rawsrc:
+					d = "{0}.css".format(path)
+				else:
+					d = "{0}.min.css".format(path)
+				style = m.element("style", [("media", "screen, print"),
+						("type", "text/css")])
+				m.set_text(style, read_file(d))
+				pe("embed", d, index_page)
+			else:
+				if self._manifest_flag("rawsrc") or self.rawsrc:
+					href = "{0}.css".format(csn)
+				else:
+					href = "{0}.min.css".format(csn)
+				if self.assets is not None:
+					href = self.assets.get(href, href)
+				elif not self.namebust:
+					href += "?_={0}".format(cb)
+				style = m.element("link", [("media", "screen, print"),
+						("rel", "stylesheet"), ("type", "text/css"),
+						("href", href)])
+			m.insert_after(bootstrap, style)
+
+		# Remove the bootstrap tag
+		replace_element(m, bootstrap)
+
+		# Handle component HTML
+		index_html = self._resolve_component_html(m, index_html)
+
+		# Parsers don't do well with the embedded files, so they are
+		# streamed into the placeholders as the page is written
+		if len(rp):
+			embed_files(index_page, m.render(index_html), rp)
 		else:
-			pe("success", "builder", self.current_manifest)
+			write_file(index_page, m.render(index_html))
+		pe("success", "application", index_page)
 
 	#------------------------------
 	# Dependency management
@@ -1344,13 +1745,21 @@ class Project(object):
 
 		return fp
 
+	def _archive_dir(self):
+		# Without the cache, archives go with the project's tmp
+		if self.from_cache:
+			return ARCHIVE_DIR
+		return join(self._tmp(), "archives")
+
 	def _clean_tmp(self):
-		# Don't delete the cache normally
-		if not self.from_cache:
+		fetch.clear()
+		# Don't delete the cache normally, or under other running targets
+		if not self.from_cache and not self.worker:
 			self._make_tmp(rm=True)
 
 	def _load_application_resources(self):
 		if self.build_project:
+			self._compile_pending_coffee()
 			if "application" in self.manifest:
 				app = self.manifest["application"]
 				if "scripts" in app and len(app["scripts"]) > 0:
@@ -1368,72 +1777,6 @@ class Project(object):
 		self._clean_tmp()
 		pe("success", "build")
 
-	def _has_library_resource(self, lib, resource):
-		if not lib in self.included:
-			self.included[lib] = {}
-
-		if not resource in self.included[lib]:
-			return False
-		else:
-			return self.included[lib][resource]["included"]
-
-	def _missing_reqs(self, reqs, pending_lib, pending_resource):
-		missing = {}
-		order = []
-
-		for lib in reqs:
-			req_resources = reqs[lib]
-
-			# In reqs, a 'dot' as a project name means 'use my project'
-			if lib == ".":
-				lib = pending_lib
-
-			if not lib in self.held_resources:
-				self.held_resources[lib] = {}
-
-			if req_resources in [".", "*"]:
-				req_resources = [lib]
-			for resource in req_resources:
-				if not self._has_library_resource(lib, resource):
-					if not resource in self.held_resources[lib]:
-						self.held_resources[lib][resource] = {}
-					held = self.held_resources[lib]
-					if not pending_lib in held[resource]:
-						held[resource][pending_lib] = []
-					held[resource][pending_lib].append(pending_resource)
-					if not lib in missing:
-						order.append(lib)
-						missing[lib] = []
-					missing[lib].append(resource)
-
-		return (missing, order)
-
-	def _remove_hold(self, held, lib, resource):
-		for library in held:
-			for held_resource in held[library]:
-				pending_lib = self.included[library]
-				if not held_resource in pending_lib:
-					return
-				pending_lib = pending_lib[held_resource]
-				for held_lib in pending_lib["requires"]:
-					if held_lib == lib:
-						pending_resources = pending_lib["requires"][held_lib]
-						for pending_resource in pending_resources:
-							if pending_resource == resource:
-								idx = pending_resources.index(pending_resource)
-								del pending_resources[idx]
-
-	def _resource_included(self, lib, resource):
-		status = self.included[lib][resource]
-		status["loading"] = False
-		status["included"] = True
-		if lib in self.held_resources:
-			held_resources = self.held_resources[lib]
-			if resource in held_resources:
-				self._remove_hold(held_resources[resource], lib, resource)
-				self._load_resources(held_resources[resource])
-		self.pending_resources -= 1
-
 	def mkpath(self, lib, resource, ftype=None):
 		path = "{0}/{1}".format(lib_path(lib), resource)
 		if ftype is not None:
@@ -1451,10 +1794,12 @@ class Project(object):
 					if not isdir(repo):
 						mkdirp(repo)
 
-					src = "{0}.coffee".format(path)
+					src = "{0}/{1}.coffee".format(self.project_dir, path)
 					dest = "{0}/{1}.js".format(repo, resource)
 
-					write_file(dest, coffeecc(read_file(src)))
+					# Compiled together before the bundles are built
+					if not self._fresh(dest, [src]):
+						self.pending_coffee.append((src, dest))
 					relative_dest = dest.replace(self.project_dir + "/", "")
 
 					self.content["js"].append(relative_dest)
@@ -1465,54 +1810,23 @@ class Project(object):
 						self.content["html"][lib] = {}
 					h = "{0}.html".format(path)
 					self.content["html"][lib][resource] = read_file(h)
-		self._resource_included(lib, resource)
-
-	def _track_resource(self, lib, resource, details):
-		if "reqs" in details:
-			missing, order = self._missing_reqs(details["reqs"], lib, resource)
-		else:
-			missing, order = {}, []
-
-		return {
-			"included": False,
-			"loading": False,
-			"requires": missing,
-			"order": order
-		}
 
 	def _get(self, lib, resource, protocol, uri, ftype, fp=None, img=None,
 			link=False):
-		global wget_cache
 		path = lib_path(lib)
 		resource_path = join(self.project_dir, path, resource)
 		cache_path = join(CACHE_DIR, lib, resource)
 
-		if fp is not None:
-			# Append resource name if the pointer ends with a slash
-			if fp[-1] == "/":
-				fp += resource
-			fprotocol, fpuri = split_uri(fp)
-			if fprotocol in ["http", "https"]:
-				protocol = fprotocol
-				uri = fpuri
-				fp = None
+		protocol, uri, fp = resolve_pointer(resource, protocol, uri, fp)
 
 		if protocol == "git":
-			repo = self.tmp_paths[uri]
+			# uri is the checkout _update_resource made for the resource
 			protocol = "file"
-			if fp is None:
-				uri = repo
-			else:
-				uri = join(repo, fp)
+			if fp is not None:
+				uri = join(uri, fp)
 			fp = None
 
-		if fp is not None:
-			uri = "/".join([uri, fp])
-		if ftype != "images":
-			uroot, uext = splitext(uri)
-			expect = ".{0}".format(ftype)
-			if uext != expect:
-				uri += expect
+		uri = resource_uri(uri, ftype, fp)
 
 		if ftype == "images":
 			resource_path += "/images"
@@ -1538,29 +1852,25 @@ class Project(object):
 			if self.from_cache:
 				get_cache = True
 				if in_cache(lib, resource, self):
-					if self.update_cache:
-						if isdir(cache_path) and cache_path not in wget_cache:
-							wget_cache[cache_path] = True
-							pe("removed", cache_path)
-							rmtree(cache_path)
-					else:
-						get_cache = False
+					# Cached files are revalidated rather than refetched
+					get_cache = self.update_cache and not self.offline
 
 				if get_cache:
 					do_get = False
 					mkdirp(cache_path)
-					wget(url, ftype, cache_dest)
+					wget(url, ftype, cache_dest, True)
 					pe("add", cache_dest, dest)
-					copyfile(cache_dest, dest)
+					materialize(cache_dest, dest)
 				elif in_cache(lib, resource, self):
 					do_get = False
 					pe("add", cache_dest, dest)
-					copyfile(cache_dest, dest)
+					materialize(cache_dest, dest)
 
 			if do_get:
 				wget(url, ftype, dest)
 
 		elif protocol == "file":
+			self._extract(uri)
 			if not isfile(uri):
 				raise UpdateError(err +
 						loc["exception"]["missing_file"].format(uri))
@@ -1575,12 +1885,42 @@ class Project(object):
 					relative_symlink(uri, dest)
 				else:
 					pe("add", uri, dest)
+					# The old file may be a hardlink into the cache
+					if isfile(dest):
+						remove(dest)
 					copyfile(uri, dest)
+					# Copies go stale when their source changes, so the
+					# update step has to run again when it does
+					self.graph_inputs.append(uri)
 			except IOError as e:
 				raise UpdateError(err +
 						loc["exception"]["copying"].format(uri, str(e)))
 		return dest
 
+	def _extract(self, path):
+		"""Extracts path from the archive it is packaged in, if any."""
+		for archive in self.archives.values():
+			archive.extract_path(path)
+
+	def _rewrite_css(self, df, fixes):
+		"""Rewrites a stylesheet's urls, unless it was rewritten before."""
+		if self.css_log is None:
+			self.css_log = RewriteLog(join(self.project_dir, CSS_LOG))
+		before = file_hash(df)
+		entry = self.css_log.get(df, fixes)
+		if entry is not None:
+			if before == entry["out"]:
+				return
+			if before == entry["in"] and has_blob(entry["out"]):
+				restore_blob(entry["out"], df)
+				return
+
+		fc = rewrite_urls(read_file(df), fixes)
+		replace_file(df, fc)
+		if self.from_cache:
+			store_blob(df)
+		self.css_log.set(df, fixes, before, content_hash(fc))
+
 	def _update_resource(self, lib, resource, details, base=None):
 		uri = None
 		if base is not None:
@@ -1619,45 +1959,61 @@ class Project(object):
 			if in_cache(lib, resource, self, full_library):
 				is_in_cache = True
 				do_cache_updates = self.update_cache
+		if self.offline:
+			# Whatever is already checked out or unpacked is all there is
+			do_cache_updates = False
 
 		if protocol == "git":
-			repo = self._make_tmp(uri, lib)
+			# Resources may pin different refs and roots of one repository
+			key = (uri, details.get("ref"), details.get("root"))
+			if key in self.tmp_paths:
+				repo = self.tmp_paths[key]
+			else:
+				# Without the cache, mirrors go with the project's tmp
+				mirror_dir = MIRROR_DIR
+				if not self.from_cache:
+					mirror_dir = join(self._tmp(), "mirrors")
+				try:
+					repo, fetched = checkout(uri, details.get("ref"),
+							do_cache_updates, mirror_dir)
+				except MirrorError as e:
+					raise UpdateError(loc["exception"]["git"].format(uri,
+							str(e)))
+				if fetched:
+					pe("clone", uri, repo)
+				if "root" in details:
+					repo = join(repo, details["root"])
+				self.tmp_paths[key] = repo
 			lib_target = repo
-
-			if isdir(repo) and do_cache_updates:
-				rmtree(repo)
-
-			if not isdir(repo):
-				pe("clone", uri, repo)
-				call(["git", "clone", "'{0}' '{1}'".format(uri, repo)])
-			if "root" in details and uri + "_orig" not in self.tmp_paths:
-				self.tmp_paths[uri + "_orig"] = repo
-				repo = join(repo, details["root"])
-				self.tmp_paths[uri] = repo
+			# _get reads git resources from this checkout
+			uri = repo
 
 		if protocol in ["http", "https"] and "packaged" in details:
 			url = "://".join([protocol, uri])
 			protocol = "file"
 
-			dest = self._make_tmp(uri, lib) + "." + details["packaged"]
-			web_dir = unpackage(dest, dry=True)
-
-			if isdir(web_dir):
-				if not dest in self.unpacked:
-					if do_cache_updates:
-						rmtree(web_dir)
-					else:
-						self.unpacked[dest] = web_dir
-
-			if not dest in self.unpacked:
-				wget(url, details["packaged"], dest)
-				self.unpacked[dest] = unpackage(dest)
-
-			uri = self.unpacked[dest]
+			if not url in self.archives:
+				package_type = details["packaged"]
+				archive_dir = self._archive_dir()
+				dest = archive_path(url, package_type, archive_dir)
+				if do_cache_updates or not isfile(dest):
+					mkdirp(dirname(dest))
+					wget(url, package_type, dest, self.from_cache)
+				try:
+					self.archives[url] = Archive(dest, package_type,
+							archive_dir)
+				except UnknownArchiveException as e:
+					raise UpdateError(loc["exception"]["archive"].format(url,
+							str(e)))
+
+			archive = self.archives[url]
+			uri = archive.tree
 			append_name = True
 			if "root" in details:
 				uri = join(uri, details["root"])
 			lib_target = uri
+			if full_library:
+				archive.extract(details.get("root"))
 
 		if full_library:
 			if lib_target is None:
@@ -1668,9 +2024,12 @@ class Project(object):
 				rmtree(full_lib_dest)
 			pe("full_lib", lib_target, full_lib_dest)
 			copytree(lib_target, full_lib_dest)
+			# In a worktree .git is a file pointing back at the mirror
 			gitdir = join(full_lib_dest, ".git")
 			if isdir(gitdir):
 				rmtree(gitdir)
+			elif exists(gitdir):
+				remove(gitdir)
 			return
 
 		if not "comp" in details:
@@ -1696,6 +2055,7 @@ class Project(object):
 				else:
 					path = "{0}/images".format(path)
 				if imgs is None:
+					self._extract(path)
 					imgs = listdir(path)
 
 			if hasattr(imgs, "keys"):
@@ -1711,21 +2071,10 @@ class Project(object):
 		def cleanup(df, ft, dt):
 			# Cleans up destination files
 			if ft == "css":
-				fc = read_file(df)
-				if "cssImageFix" in dt:
-					fix = dt["cssImageFix"]
-					if isinstance(fix, basestring) or isinstance(fix, str):
-						fix = [fix]
-					for fx in fix:
-						fc = fc.replace(fx, "images")
-				for m in findall('url\(([^)]+)\)', fc):
-					u = m.replace("'", "").replace('"', "")
-					if u[0:5] != "data:":
-						if "images/" not in u:
-							u = "images/{0}".format(u)
-					fc = fc.replace(m, u)
-				# Strip strings from images
-				write_file(df, fc)
+				fix = dt.get("cssImageFix", [])
+				if isinstance(fix, basestring) or isinstance(fix, str):
+					fix = [fix]
+				self._rewrite_css(df, fix)
 
 		if protocol == "git":
 			append_name = True
@@ -1761,17 +2110,89 @@ class Project(object):
 					cleanup(df, ftype, details)
 			details["comp"] = [x if x != "images/" else "images" for x in comp]
 
-	def _update_library(self, lib):
+	def _library_manifest_path(self, lib):
 		tpl = "{0}/manifests/{1}.json"
 		manifest_path = tpl.format(self.project_dir, lib)
 		if not exists(manifest_path):
 			manifest_path = tpl.format(USER_DIR, lib)
+		return manifest_path
+
+	def _dep_lock(self):
+		"""The project's ford.lock; lock() is the unrelated busy-lock."""
+		if self.dep_lock is None:
+			path = join(dirname(self.project_manifest), LOCK_FILE)
+			self.dep_lock = LockFile(path, self.relock)
+		return self.dep_lock
+
+	def _locked_entry(self, lib, manifest_hash, locked):
+		"""Returns the ford.lock entry an update would restore lib from."""
+		if locked is None or not self.from_cache or self.update_cache:
+			return None
+		return self._dep_lock().library(lib, manifest_hash)
+
+	def _save_dep_lock(self):
+		if self.dep_lock is None:
+			return
+		manifest_hash = content_hash(read_file(self.project_manifest))
+		if self.dep_lock.save(manifest_hash):
+			pe("locked", self.dep_lock.path)
+
+	def _locked_resources(self, manifest):
+		"""Lists the uri and version of each resource, or None if local.
+
+		Local files and links are read from disk on every update, so a
+		library using any of them is never locked.
+		"""
+		base = manifest.get("*", {})
+		resources = {}
+		for resource in manifest:
+			if resource == "*":
+				continue
+			details = dict(base)
+			details.update(manifest[resource])
+			uri = None
+			for f in ["uri", "url", "path"]:
+				if f in details:
+					uri = details[f]
+					break
+			if "link" in details:
+				return None
+			if uri is not None and split_uri(uri)[0] == "file":
+				return None
+			resources[resource] = {
+				"uri": uri,
+				"version": details.get("version")
+			}
+		return resources
+
+	def _update_library(self, lib):
+		manifest_path = self._library_manifest_path(lib)
+		self.updated_libs.append(lib)
+		if exists(manifest_path):
+			self.graph_inputs.append(manifest_path)
 		try:
 			manifest = get_json(manifest_path)
 		except:
 			return
 
+		lib_dir = join(self.project_dir, lib_path(lib))
+		lib_manifest = join(lib_dir, "manifest.json")
+		do_update = True
+		if "skip_update" in self.manifest:
+			if lib in self.manifest["skip_update"]:
+				do_update = False
+
+		manifest_hash = content_hash(read_file(manifest_path))
+		locked = self._locked_resources(manifest)
+		if do_update:
+			entry = self._locked_entry(lib, manifest_hash, locked)
+			if entry is not None:
+				self.dep_lock.restore(entry, lib_dir)
+				pe("restored", lib_dir)
+				return lib_manifest
+
 		write_manifest = True
+		missing = len(self.missing)
 		try:
 			base = None
 			if "*" in manifest:
@@ -1779,102 +2200,216 @@ class Project(object):
 				del manifest["*"]
 			if "." in manifest:
 				write_manifest = False
-			do_update = True
-			if "skip_update" in self.manifest:
-				if lib in self.manifest["skip_update"]:
-					do_update = False
 			if do_update:
 				for resource in manifest:
 					details = manifest[resource]
-					self._update_resource(lib, resource, details, base)
+					try:
+						self._update_resource(lib, resource, details, base)
+					except OfflineError as e:
+						self.missing.append((lib, resource, e.url))
 		except UpdateError as e:
 			printr(e, "red")
 			self.exit(1)
+		incomplete = len(self.missing) > missing
+		if incomplete:
+			locked = None
 
-		lib_manifest = join(self.project_dir, lib_path(lib), "manifest.json")
 		if do_update:
 			cache_manifest = join(CACHE_DIR, lib, "manifest.json")
 			if write_manifest:
 				raw_json = dumps(manifest)
-				write_file(lib_manifest, raw_json)
-				if self.from_cache:
+				replace_file(lib_manifest, raw_json)
+				# in_cache() trusts the cache manifest, so a library missing
+				# files must not get one, or they count as downloaded later
+				if self.from_cache and not incomplete:
+					# Git libraries live in the mirrors, not under CACHE_DIR
+					mkdirp(dirname(cache_manifest))
 					write_file(cache_manifest, raw_json)
+			if locked is not None:
+				self._dep_lock().record(lib, manifest_hash, locked, lib_dir)
 		return lib_manifest
 
-	def _include_library_resource(self, lib, resource):
+	def _load_library(self, lib):
+		if not lib in self.libraries:
+			if self.update_project:
+				self._update_library(lib)
+			self.libraries[lib] = expand_manifest(lib,
+				get_manifest(lib_path(lib)), self)
+
+	def _library_resources(self, lib, resources):
+		"""Names the (lib, resource) nodes an include or requirement means."""
+		replaced = lib
+		lib = replace_library(lib, self)
+		if resources in [".", "*"]:
+			resources = [lib]
+		return [(lib, lib if r == replaced else r) for r in resources]
+
+	def _requirements(self, node):
+		lib, resource = node
+		self._load_library(lib)
 		manifest = self.libraries[lib]
-		includes = self.included[lib]
 
 		if not resource in manifest:
 			pe("exception", "missing_resource", resource, lib)
 			self.exit(1)
 
+		# Requirements are grouped by library, libraries in first-seen order
+		missing = {}
+		order = []
 		details = manifest[resource]
+		if "reqs" in details:
+			for req_lib in details["reqs"]:
+				req_resources = details["reqs"][req_lib]
+				# In reqs, a 'dot' as a project name means 'use my project'
+				if req_lib == ".":
+					req_lib = lib
+				if req_resources in [".", "*"]:
+					req_resources = [req_lib]
+				if not req_lib in missing:
+					order.append(req_lib)
+					missing[req_lib] = []
+				missing[req_lib] += req_resources
+
+		reqs = []
+		for req_lib in order:
+			reqs += self._library_resources(req_lib, missing[req_lib])
+		return reqs
+
+	def _load_resources(self, includes):
+		includes = expand_libs(includes, self)
+		roots = []
+		for lib in includes:
+			roots += self._library_resources(lib, includes[lib])
 
-		if not resource in includes:
-			includes[resource] = self._track_resource(lib, resource, details)
-			self.pending_resources += 1
+		try:
+			order = Resolver(self._requirements).resolve(roots)
+		except CycleError as e:
+			pe("exception", "cycle", str(e))
+			self.exit(1)
 
-		status = includes[resource]
+		if len(self.missing):
+			for lib, resource, url in self.missing:
+				pe("exception", "offline", "/".join([lib, resource]), url)
+			pe("exception", "offline_failed", len(self.missing))
+			self.exit(1)
 
-		if not status["included"]:
-			has_requirements = False
-			if len(status["requires"]) > 0:
-				for req_lib in status["requires"]:
-					if len(status["requires"][req_lib]) > 0:
-						has_requirements = True
-						break;
+		for lib, resource in order:
+			self._include(lib, resource, self.libraries[lib][resource]["comp"])
 
-			if has_requirements:
-				self._load_resources(status["requires"], status["order"])
-			elif not status["loading"]:
-				status["loading"] = True
-				self._include(lib, resource, details["comp"])
+	def _resource_urls(self, lib, resource, details):
+		"""Lists the (url, headers) requests _update_resource will make."""
+		uri = None
+		for f in ["uri", "url", "path"]:
+			if f in details:
+				uri = details[f]
+				break
+		if not uri:
+			return []
 
-	def _include_library_resources(self, lib, resources):
-		if not lib in self.libraries:
-			if self.update_project:
-				self._update_library(lib)
-			path = lib_path(lib)
-			self.libraries[lib] = expand_manifest(lib,
-				get_manifest(lib_path(lib)), self)
-			self.included[lib] = {}
+		protocol, uri = split_uri(uri)
+		if protocol not in ["http", "https"]:
+			return []
 
-		replaced = lib
-		lib = replace_library(lib, self)
-		if lib == replaced:
-			replaced = None
+		append_name = False
+		if uri[-1] == "/":
+			append_name = True
+			uri = uri[:-1]
 
-		if resources in [".", "*"]:
-			resources = [lib]
-		for r in resources:
-			if r == replaced:
-				r = lib
-			self._include_library_resource(lib, r)
+		if resource == ".":
+			resource = lib
 
-	def _load_resources(self, includes, order=None, proceed_if_empty=False):
-		has_resources = False
+		if "packaged" in details:
+			url = "://".join([protocol, uri])
+			dest = archive_path(url, details["packaged"], self._archive_dir())
+			if isfile(dest):
+				if self.from_cache and not self.update_cache:
+					return []
+				return [(url, conditional_headers(dest))]
+			return [(url, None)]
+
+		if self.from_cache and not self.update_cache:
+			if in_cache(lib, resource, self):
+				return []
+
+		urls = []
+		comp = details.get("comp", [])
+		if hasattr(comp, "keys"):
+			pointers = [(f, comp[f]) for f in comp.keys()]
+		else:
+			pointers = []
+			for ftype in comp:
+				fp = None
+				if append_name:
+					fp = "{0}.{1}".format(resource, ftype)
+				pointers.append((ftype, fp))
 
-		includes = expand_libs(includes, self)
+		for ftype, fp in pointers:
+			if ftype in ["images", "images/"] or not ftype in VALID_COMPS:
+				continue
+			p, u, f = resolve_pointer(resource, protocol, uri, fp)
+			url = "://".join([p, resource_uri(u, ftype, f)])
+			headers = None
+			if self.from_cache:
+				fname = ".".join([resource, ftype])
+				headers = conditional_headers(join(CACHE_DIR, lib, resource,
+						fname))
+			urls.append((url, headers))
+		return urls
+
+	def _prefetch(self):
+		"""Downloads every remote resource reachable from the includes."""
+		# --fetch-jobs wins over the manifest, which wins over the default
+		jobs = self.fetch_jobs
+		if jobs is None:
+			jobs = int(self.manifest.get("fetch_jobs", DEFAULT_JOBS))
+		if jobs <= 1 or not "includes" in self.manifest:
+			return
 
-		if order is not None:
-			for lib in order:
-				has_resources = True
-				self._include_library_resources(lib, includes[lib])
-		else:
-			for lib in includes:
-				has_resources = True
-				self._include_library_resources(lib, includes[lib])
+		skip = []
+		if "skip_update" in self.manifest:
+			skip = self.manifest["skip_update"]
+
+		urls = []
+		seen = set()
+		pending = expand_libs(loads(dumps(self.manifest["includes"])), self)
+		pending = pending.keys()
+		while len(pending):
+			lib = pending.pop(0)
+			if lib in seen:
+				continue
+			seen.add(lib)
+
+			manifest_path = self._library_manifest_path(lib)
+			try:
+				manifest = get_json(manifest_path, True)
+			except JSONError:
+				continue
 
-		if not has_resources and proceed_if_empty:
-			self._load_application_resources()
+			# Libraries restored from ford.lock need nothing downloaded
+			restored = self._locked_entry(lib,
+					content_hash(read_file(manifest_path)),
+					self._locked_resources(manifest)) is not None
+
+			base = manifest.pop("*", None)
+			for resource in manifest:
+				details = manifest[resource]
+				if base is not None:
+					details.update(loads(dumps(base)))
+				if "reqs" in details:
+					reqs = expand_libs(details["reqs"], self)
+					pending += [lib if l == "." else l for l in reqs]
+				if not lib in skip and not restored:
+					urls += self._resource_urls(lib, resource, details)
+
+		prefetch(urls, jobs)
 
 	def _handle_project_dependencies(self):
+		fetch.offline = self.offline
+		if self.update_project:
+			self._prefetch()
 		if "includes" in self.manifest:
-			self._load_resources(self.manifest["includes"], None,
-					self.build_project)
-		if self.pending_resources == 0:
-			self._load_application_resources()
+			self._load_resources(self.manifest["includes"])
+		self._load_application_resources()
 
 	#------------------------------
 	#
@@ -1985,19 +2520,133 @@ class Project(object):
 		self.current_manifest = self.project_manifest
 		self.manifest = get_json(self.project_manifest)
 		self._handle_project_dependencies()
+		self._save_dep_lock()
 		self._clean_tmp()
+		report_connections()
 
 	#------------------------------
 	# Build
 	#------------------------------
 
 	def _build(self):
+		self._prepare()
+		self.graph = self._load_graph()
+
+		# Libraries only need updating when a manifest they came from changes
+		step = "update"
+		values = {"from_cache": self.from_cache}
+		inputs = None
+		if self.update_project and not self.update_cache and not self.relock:
+			if self._fresh(step, None, values):
+				self.update_project = False
+
 		if self.update_project:
 			pe("action", "update", self.project_dir)
-		self._prepare()
+			inputs = [self.current_manifest]
 		self.build_project = True
 		self._handle_project_dependencies()
 
+		if self.update_project:
+			self._save_dep_lock()
+
+		if self.graph is not None:
+			if inputs is not None:
+				outputs = []
+				for lib in self.updated_libs:
+					outputs += self.graph.tree(join(self.project_dir,
+							lib_path(lib)))
+				self._record(step, inputs + self.graph_inputs, values, outputs)
+			self.graph.save()
+
+	def _build_target(self, target, update):
+		self.update_project = update
+		bm = BUILD_TARGET.format(self.project_dir, target)
+		self.current_manifest = bm
+		self.manifest = get_json(bm)
+		self._build()
+
+	def _target_outputs(self, target):
+		"""Lists a target's bundle and page paths, and the assets it copies."""
+		self.manifest = self._target_manifest(target)
+		# Name busted bundles are named at build time, so may collide too
+		jsn, csn, htn = self._output_names("application")[:3]
+		build_index = self._builds_index()
+		outputs = [jsn + ".js", jsn + ".min.js", csn + ".css",
+				csn + ".min.css"]
+		if build_index:
+			outputs.append(htn + ".html")
+		return outputs, self._asset_copies(build_index)
+
+	def _target_chains(self, targets):
+		"""Groups targets so that no two groups write the same outputs.
+
+		Each group is built in order by one worker; the groups run at once.
+		Assets more than one target copies (localization, say) are returned
+		apart, to be copied once before any of them start.
+		"""
+		outputs, assets = {}, {}
+		for target in targets:
+			outputs[target], assets[target] = self._target_outputs(target)
+		copies = sum(assets.values(), [])
+		shared = [a for a in set(copies) if copies.count(a) > 1]
+		for target in targets:
+			outputs[target] += [basename(fd) if flatten else fd
+					for fd, flatten, is_file in assets[target]
+					if (fd, flatten, is_file) not in shared]
+
+		chains = []
+		for target in targets:
+			chain = ([target], outputs[target])
+			for other in list(chains):
+				if any(overlaps(a, b) for a in chain[1] for b in other[1]):
+					chains.remove(other)
+					chain = (other[0] + chain[0], other[1] + chain[1])
+			chains.append(chain)
+		# Keep the manifest order as far as the groups allow
+		for c in chains:
+			c[0].sort(key=targets.index)
+		chains.sort(key=lambda c: targets.index(c[0][0]))
+		return [c[0] for c in chains], shared
+
+	def _build_targets(self, targets):
+		"""Builds targets in worker processes, printing each one's output."""
+		global parallel_project
+		chains, shared = self._target_chains(targets)
+		self.current_manifest = self.project_manifest
+		self.manifest = get_json(self.project_manifest)
+		self.graph = self._load_graph()
+		for asset in shared:
+			self._include_asset(*asset)
+		if self.graph is not None:
+			self.graph.save()
+		self.shared_assets = set(shared)
+		parallel_project = self
+		pool = Pool(min(self.build_jobs, len(chains)))
+		failed = False
+		try:
+			for results in pool.imap(build_chain, chains):
+				for target, ok, log in results:
+					pe("target", BUILD_TARGET.format(self.project_dir, target),
+							ok)
+					sys.stdout.write(log)
+					failed = failed or not ok
+		finally:
+			pool.close()
+			pool.join()
+			parallel_project = None
+			self.shared_assets = set()
+		# The workers saved the target graphs; read them back when needed
+		self.graphs = {}
+		if failed:
+			self.exit(1)
+		# Compressing walks the whole output, so it waits for every worker
+		for option in set(dumps(self._target_manifest(t).get("compress"))
+				for t in targets):
+			self._compress(loads(option))
+
+	def _target_manifest(self, target):
+		return get_json(BUILD_TARGET.format(self.project_dir, target))
+
 	def build(self, out_dir, skip, embed, rawsrc, cln, namebust):
 		self.current_manifest = self.project_manifest
 		self.manifest = get_json(self.project_manifest)
@@ -2017,14 +2666,17 @@ class Project(object):
 				pe("created", self.output_dir)
 		mkdirp(self.output_dir)
 		if "build_targets" in self.manifest:
-			build_idx = 0
-			for target in self.manifest["build_targets"]:
-				self.update_project = build_idx == 0 and not skip
-				bm = BUILD_TARGET.format(self.project_dir, target)
-				self.current_manifest = bm
-				self.manifest = get_json(bm)
-				self._build()
-				build_idx += 1
+			targets = self.manifest["build_targets"]
+			if self.build_jobs > 1 and len(targets) > 2:
+				# The first target updates the libraries the others share
+				self._build_target(targets[0], not skip)
+				self._build_targets(targets[1:])
+				self.update_project = False
+			else:
+				build_idx = 0
+				for target in targets:
+					self._build_target(target, build_idx == 0 and not skip)
+					build_idx += 1
 			self.current_manifest = self.project_manifest
 			self.manifest = get_json(self.project_manifest)
 			if "only_build_targets" in self.manifest:
@@ -2034,4 +2686,5 @@ class Project(object):
 		else:
 			self.update_project = not skip
 			self._build()
+		report_connections()
 
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Orders library resources so that each follows everything it requires."""
+
+class CycleError(Exception):
+	"""Raised with the resources that require each other, in order."""
+
+	def __init__(self, cycle):
+		Exception.__init__(self, " -> ".join("/".join(n) for n in cycle))
+		self.cycle = cycle
+
+class Resolver(object):
+	"""Resolves (lib, resource) nodes into the order they must be included.
+
+	requirements(node) lists the nodes a node requires, in the order they
+	should be included. It is asked once per node, when the node is first
+	reached, so it is also where a library gets loaded.
+	"""
+
+	def __init__(self, requirements):
+		self.requirements = requirements
+		self.graph = {}
+
+	def resolve(self, roots):
+		"""Lists every node reachable from roots, requirements first.
+
+		Nodes come out in depth first post-order, so roots and requirements
+		keep the order they were given in wherever the graph allows.
+		"""
+		order = []
+		done = set()
+		for root in roots:
+			if root in done:
+				continue
+			# Each frame is a node and the index of its next requirement
+			stack = [[root, 0]]
+			active = set([root])
+			while len(stack):
+				frame = stack[-1]
+				node = frame[0]
+				if not node in self.graph:
+					self.graph[node] = self.requirements(node)
+				reqs = self.graph[node]
+				if frame[1] < len(reqs):
+					req = reqs[frame[1]]
+					frame[1] += 1
+					if req in done:
+						continue
+					if req in active:
+						cycle = [f[0] for f in stack]
+						raise CycleError(cycle[cycle.index(req):] + [req])
+					stack.append([req, 0])
+					active.add(req)
+				else:
+					stack.pop()
+					active.remove(node)
+					done.add(node)
+					order.append(node)
+		return order
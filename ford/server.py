@@ -1,14 +1,280 @@
 #!/usr/bin/env python
 
 import socket, os
-from os import chdir
+from errno import EAGAIN, EWOULDBLOCK
+from os import chdir, fstat
+from os.path import isdir, isfile, join, basename
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+from re import match
+from select import select
 from SocketServer import BaseServer, TCPServer, ThreadingMixIn
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from SimpleHTTPServer import SimpleHTTPRequestHandler
-from threading import Thread
+from threading import Thread, Lock
+
+from compress import compressible, negotiate
+from fingerprint import FINGERPRINTED
+
+try:
+	from sendfile import sendfile
+except ImportError:
+	sendfile = None
+
+CHUNK = 64 * 1024
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+#------------------------------
+# Static files
+#------------------------------
+
+class FileCache(object):
+	"""A least recently used cache of small files, checked against stat."""
+
+	def __init__(self, max_bytes=32 * 1024 * 1024, max_file=256 * 1024):
+		self.max_bytes = max_bytes
+		self.max_file = max_file
+		self.files = OrderedDict()
+		self.size = 0
+		self.lock = Lock()
+
+	def get(self, path, st):
+		with self.lock:
+			entry = self.files.pop(path, None)
+			if entry is None:
+				return None
+			if entry[0] != (st.st_mtime, st.st_size):
+				self.size -= len(entry[1])
+				return None
+			self.files[path] = entry
+			return entry[1]
+
+	def put(self, path, st, data):
+		if len(data) > self.max_file:
+			return
+		with self.lock:
+			old = self.files.pop(path, None)
+			if old is not None:
+				self.size -= len(old[1])
+			self.files[path] = ((st.st_mtime, st.st_size), data)
+			self.size += len(data)
+			while self.size > self.max_bytes:
+				key, entry = self.files.popitem(last=False)
+				self.size -= len(entry[1])
+
+file_cache = FileCache()
+
+class FileBody(object):
+	"""The part of a file a response sends, from memory or from disk."""
+
+	def __init__(self, f, start, length, data=None):
+		self.f = f
+		self.start = start
+		self.length = length
+		self.data = data
+
+	def close(self):
+		if self.f is not None:
+			self.f.close()
+
+class FordHTTPRequestHandler(SimpleHTTPRequestHandler):
+	"""Serves static files with validators, ranges and keep-alive.
+
+	Responses carry an ETag and Last-Modified so browsers revalidate with a
+	304 instead of downloading again. Small files are answered from memory,
+	and large ones with sendfile() when pysendfile is installed.
+	"""
+
+	protocol_version = "HTTP/1.1"
+	# Send headers and small bodies together, without waiting on acks
+	wbufsize = CHUNK
+	disable_nagle_algorithm = True
+	# Idle keep-alive connections give their thread back after this
+	timeout = 30
+	cache_control = "no-cache"
+
+	def _redirect(self, location):
+		self.send_response(301)
+		self.send_header("Location", location)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+
+	def _not_modified(self, etag, mtime):
+		inm = self.headers.getheader("If-None-Match")
+		if inm is not None:
+			return etag in [t.strip() for t in inm.split(",")] or inm == "*"
+		ims = self.headers.getheader("If-Modified-Since")
+		if ims is not None:
+			t = parsedate_tz(ims)
+			return t is not None and int(mtime) <= mktime_tz(t)
+		return False
+
+	def _range(self, size, etag):
+		"""Returns the (start, length) a Range header asks for, if any."""
+		rng = self.headers.getheader("Range")
+		if rng is None:
+			return None
+		if_range = self.headers.getheader("If-Range")
+		if if_range is not None and if_range != etag:
+			return None
+		m = match(r"^bytes=(\d*)-(\d*)$", rng.strip())
+		# Multiple ranges are answered with the whole file
+		if m is None or m.group(1) == m.group(2) == "":
+			return None
+		if m.group(1) == "":
+			start = max(0, size - int(m.group(2)))
+			end = size - 1
+		else:
+			start = int(m.group(1))
+			end = size - 1
+			if m.group(2) != "":
+				end = min(int(m.group(2)), end)
+		if start >= size or end < start:
+			return False
+		return start, end - start + 1
+
+	def send_head(self):
+		path = self.translate_path(self.path)
+		if isdir(path):
+			if not self.path.split("?")[0].endswith("/"):
+				parts = self.path.split("?", 1)
+				parts[0] += "/"
+				self._redirect("?".join(parts))
+				return None
+			for index in ["index.html", "index.htm"]:
+				if isfile(join(path, index)):
+					path = join(path, index)
+					break
+			else:
+				return SimpleHTTPRequestHandler.send_head(self)
+		# Precompressed siblings are sent as they are
+		content_path = path
+		path, encoding = negotiate(path,
+				self.headers.getheader("Accept-Encoding"))
+		try:
+			f = open(path, "rb")
+		except IOError:
+			self.send_error(404, "File not found")
+			return None
+
+		st = fstat(f.fileno())
+		etag = '"{0:x}-{1:x}"'.format(int(st.st_mtime), st.st_size)
+		headers = [
+			("ETag", etag),
+			("Last-Modified", self.date_time_string(st.st_mtime)),
+			("Cache-Control", self.cache_control_for(content_path)),
+			("Accept-Ranges", "bytes")
+		]
+		if encoding is not None:
+			headers.append(("Content-Encoding", encoding))
+		if compressible(content_path):
+			headers.append(("Vary", "Accept-Encoding"))
+		if self._not_modified(etag, st.st_mtime):
+			f.close()
+			self.send_response(304)
+			for k, v in headers:
+				self.send_header(k, v)
+			self.end_headers()
+			return None
+
+		start, length = 0, st.st_size
+		rng = self._range(st.st_size, etag)
+		if rng is False:
+			f.close()
+			self.send_response(416)
+			self.send_header("Content-Range", "bytes */{0}".format(st.st_size))
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return None
+		if rng is not None:
+			start, length = rng
+			self.send_response(206)
+			self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(
+					start, start + length - 1, st.st_size))
+		else:
+			self.send_response(200)
+		self.send_header("Content-Type", self.guess_type(content_path))
+		self.send_header("Content-Length", str(length))
+		for k, v in headers:
+			self.send_header(k, v)
+		self.end_headers()
+
+		data = file_cache.get(path, st)
+		if data is None and st.st_size <= file_cache.max_file:
+			data = f.read()
+			file_cache.put(path, st, data)
+		if data is not None:
+			f.close()
+			return FileBody(None, start, length, data)
+		return FileBody(f, start, length)
+
+	def cache_control_for(self, path):
+		# A fingerprinted name always holds the same content
+		if FINGERPRINTED.search(basename(path)):
+			return IMMUTABLE
+		return self.cache_control
+
+	def _sendfile(self, body):
+		# Only plain sockets can send straight from the page cache
+		if sendfile is None or not isinstance(self.connection, socket.socket):
+			return False
+		self.wfile.flush()
+		out = self.connection.fileno()
+		offset, remaining = body.start, body.length
+		while remaining > 0:
+			try:
+				sent = sendfile(out, body.f.fileno(), offset, remaining)
+			except OSError as e:
+				# A socket with a timeout is non-blocking underneath
+				if e.errno not in (EAGAIN, EWOULDBLOCK):
+					raise
+				if not select([], [out], [], self.timeout)[1]:
+					raise socket.timeout("timed out")
+				continue
+			if sent == 0:
+				break
+			offset += sent
+			remaining -= sent
+		return True
+
+	def send_body(self, body):
+		if body.data is not None:
+			self.wfile.write(body.data[body.start:body.start + body.length])
+		elif not self._sendfile(body):
+			body.f.seek(body.start)
+			remaining = body.length
+			while remaining > 0:
+				chunk = body.f.read(min(CHUNK, remaining))
+				if not chunk:
+					break
+				self.wfile.write(chunk)
+				remaining -= len(chunk)
+
+	def do_GET(self):
+		body = self.send_head()
+		if body is None:
+			return
+		try:
+			if isinstance(body, FileBody):
+				self.send_body(body)
+			else:
+				self.copyfile(body, self.wfile)
+		finally:
+			body.close()
+
+	def do_HEAD(self):
+		body = self.send_head()
+		if body is not None:
+			body.close()
+
+	def log_message(self, format, *args):
+		# Logging every hit to a daemon's stderr costs more than the hit
+		if getattr(self.server, "verbose", True):
+			SimpleHTTPRequestHandler.log_message(self, format, *args)
 
 class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
-	pass
+	daemon_threads = True
+	verbose = False
 
 def serve_on_port(port, dest=None):
 	if port == 443:
@@ -16,7 +282,7 @@ def serve_on_port(port, dest=None):
 	else:
 		if dest is not None:
 			chdir(dest)
-		server = ThreadingHTTPServer(("",port), SimpleHTTPRequestHandler)
+		server = ThreadingHTTPServer(("",port), FordHTTPRequestHandler)
 		server.serve_forever()
 
 def threaded(port=8080, dest=None):
@@ -26,7 +292,8 @@ def threaded(port=8080, dest=None):
 		pass
 
 def simple(port=8080):
-	server = HTTPServer(("", port), SimpleHTTPRequestHandler)
+	server = ThreadingHTTPServer(("", port), FordHTTPRequestHandler)
+	server.verbose = True
 	sa = server.socket.getsockname()
 	print "Serving HTTP on", sa[0], "port", sa[1], "..."
 	try:
@@ -47,7 +314,10 @@ try:
 	from: http://code.activestate.com/recipes/442473-simple-http-server-supporting-ssl-secure-communica/
 	'''
 
-	class SecureHTTPServer(HTTPServer):
+	class SecureHTTPServer(ThreadingMixIn, HTTPServer):
+		daemon_threads = True
+		verbose = False
+
 		def __init__(self, server_address, HandlerClass):
 			BaseServer.__init__(self, server_address, HandlerClass)
 			ctx = SSL.Context(SSL.SSLv23_METHOD)
@@ -70,7 +340,7 @@ try:
 		def shutdown_request(self,request):
 			request.shutdown()
 
-	class SecureHTTPRequestHandler(SimpleHTTPRequestHandler):
+	class SecureHTTPRequestHandler(FordHTTPRequestHandler):
 		def setup(self):
 			self.connection = self.request
 			self.rfile = socket._fileobject(self.request, "rb", self.rbufsize)
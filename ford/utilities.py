@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 from os.path import (expanduser, isdir, exists, join, abspath, splitext,
 	basename, dirname)
-from os import mkdir, makedirs, listdir, remove
+from os import mkdir, makedirs, listdir, remove, rename, getpid
 from errno import EEXIST
 from subprocess import Popen, PIPE, STDOUT
 from types import ListType
@@ -30,6 +30,12 @@ def write_file(file_path, content, mode="w"):
 	with open(file_path, mode) as stream:
 		stream.write(content)
 
+def replace_file(file_path, content):
+	"""Writes a file via rename, leaving any hardlinked copies untouched."""
+	tmp = "{0}.{1}.tmp".format(file_path, getpid())
+	write_file(tmp, content)
+	rename(tmp, file_path)
+
 def call(cmd, failexit=False, output=False, fout=False, tab=False, sout=False):
 	if type(cmd) == ListType:
 		cmd = " ".join(cmd)
@@ -283,7 +289,13 @@ loc = {
 		"not_project": "[INVALID] {0:<80} Is not a project. Try ford init?",
 		"resource": "[ ERROR ] {0} {1}",
 		"copying": "[NO COPY] {0:<80} {1}",
-		"http": "[HTTPERR] {1:<80} {0}"
+		"http": "[HTTPERR] {1:<80} {0}",
+		"git": "[GIT ERR] {0:<80} {1}",
+		"archive": "[ARCHIVE] {0:<80} Unknown archive type {1}",
+		"coffee": "[ERR CS ] {0:<80} {1}",
+		"cycle": "[ CYCLE ] {0}",
+		"offline": "[OFFLINE] {0:<80} {1}",
+		"offline_failed": "[OFFLINE] {0} resource(s) are not cached"
 	},
 	"compiling": "[ BEGIN ] {0:<80}",
 	"embed": "[ EMBED ] {0:<80} {1:<80}",
@@ -300,7 +312,18 @@ loc = {
 	"ignored": "[CUT OUT] {0:<80}",
 	"created": "[ MKDIR ] {0:<80}",
 	"removed": "[REMOVED] {0:<80}",
-	"symlink": "[SYMLINK] {0:<80} {1:<80}"
+	"unchanged": "[NOT MOD] {0:<80}",
+	"uptodate": "[UP2DATE] {0:<80}",
+	"watch": "[ WATCH ] {0:<80}",
+	"rebuilt": "[REBUILT] {0} changed file(s), {1:.3f}s",
+	"rebuild_failed": "[FAILED!] {0} changed file(s), {1:.3f}s",
+	"compressed": "[COMPRES] {0} variant(s) in {1}",
+	"restored": "[RESTORE] {0:<80}",
+	"locked": "[ LOCKED] {0:<80}",
+	"target": "[TARGET ] {0:<80}",
+	"target_failed": "[FAILED!] {0:<80}",
+	"symlink": "[SYMLINK] {0:<80} {1:<80}",
+	"connections": "[ CONNS ] {0} opened, {1} reused"
 }
 
 USR_PATH = expanduser("~")
@@ -347,12 +370,32 @@ def print_event(event, *args):
 		printr(l.format(shrt(args[0])), "cyan", atrs)
 	elif event == "ignored":
 		printr(l.format(shrt(args[0])), "magenta", atrs)
+	elif event in ["unchanged", "uptodate", "restored", "locked"]:
+		printr(l.format(shrt(args[0])), "green", atrs)
 	elif event == "removed":
 		printr(l.format(shrt(args[0])), "red", atrs)
 	elif event == "compiling":
 		printr(l.format(shrt(args[0])), "white", atrs)
 	elif event == "symlink":
 		printr(l.format(shrt(args[0]), shrt(args[1])), "cyan", atrs)
+	elif event == "watch":
+		printr(l.format(shrt(args[0])), "white", ["bold"])
+	elif event == "rebuilt":
+		if args[2]:
+			printr(l.format(args[0], args[1]), "green", ["bold"])
+		else:
+			l = loc["rebuild_failed"]
+			printr(l.format(args[0], args[1]), "red", ["bold"])
+	elif event == "target":
+		if args[1]:
+			printr(l.format(shrt(args[0])), "white", ["bold"])
+		else:
+			l = loc["target_failed"]
+			printr(l.format(shrt(args[0])), "red", ["bold"])
+	elif event == "compressed":
+		printr(l.format(args[0], shrt(args[1])), "green", atrs)
+	elif event == "connections":
+		printr(l.format(*args), "cyan", atrs)
 	elif event == "import":
 		p = args[0]
 		printr(l.format(shrt(p["name"]), p["version"]), "magenta", atrs)
@@ -387,7 +430,8 @@ def print_event(event, *args):
 			printr(l, "red", atrs)
 		elif event == "exception":
 			k = args[0]
-			if k in ["invalid_file", "missing_tag", "missing_resource"]:
+			if k in ["invalid_file", "missing_tag", "missing_resource",
+					"coffee", "offline"]:
 				printr(l.format(args[1], args[2]), "red", atrs)
 			elif k == "missing_property":
 				printr(l.format(args[1], pformat([2])), "red", atrs)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""Watches a project tree and rebuilds it whenever its files change."""
+
+from os import walk, stat
+from os.path import join, realpath
+from time import time, sleep
+
+from utilities import print_event as pe
+
+try:
+	import pyinotify
+except ImportError:
+	pyinotify = None
+
+IGNORED_DIRS = [".git", ".svn", ".hg", ".ford-build", "tmp"]
+POLL_INTERVAL = 0.25
+SETTLE_TIME = 0.05
+
+def _ignored(path, ignored):
+	for i in ignored:
+		if path == i or path.startswith(i + "/"):
+			return True
+	return False
+
+class PollingWatcher(object):
+	"""Finds changes by comparing mtimes and sizes across the tree."""
+
+	def __init__(self, root, ignored):
+		self.root = root
+		self.ignored = ignored
+		self.state = self._snapshot()
+
+	def _snapshot(self):
+		state = {}
+		for root, dirs, files in walk(self.root):
+			dirs[:] = [d for d in dirs if not _ignored(join(root, d),
+					self.ignored)]
+			for f in files:
+				fp = join(root, f)
+				if _ignored(fp, self.ignored):
+					continue
+				try:
+					st = stat(fp)
+				except OSError:
+					continue
+				state[fp] = (st.st_mtime, st.st_size)
+		return state
+
+	def wait(self):
+		while True:
+			sleep(POLL_INTERVAL)
+			state = self._snapshot()
+			changed = [f for f in set(state) | set(self.state)
+					if state.get(f) != self.state.get(f)]
+			self.state = state
+			if len(changed):
+				return changed
+
+class InotifyWatcher(object):
+	"""Uses inotify to block until something in the tree changes."""
+
+	def __init__(self, root, ignored):
+		self.changed = set()
+		mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE |
+				pyinotify.IN_DELETE | pyinotify.IN_MOVED_TO |
+				pyinotify.IN_MOVED_FROM)
+
+		def record(event):
+			if not _ignored(event.pathname, ignored):
+				self.changed.add(event.pathname)
+
+		wm = pyinotify.WatchManager()
+		self.notifier = pyinotify.Notifier(wm, record)
+		wm.add_watch(root, mask, rec=True, auto_add=True,
+				exclude_filter=lambda p: _ignored(p, ignored))
+
+	def _pump(self, timeout=None):
+		# Blocks until there are events, or for timeout milliseconds
+		if self.notifier.check_events(timeout):
+			self.notifier.read_events()
+			self.notifier.process_events()
+			return True
+		return False
+
+	def wait(self):
+		while not len(self.changed):
+			self._pump()
+		# Editors save in bursts; let them settle into a single rebuild
+		while self._pump(SETTLE_TIME * 1000):
+			pass
+		changed = list(self.changed)
+		self.changed = set()
+		return changed
+
+def make_watcher(root, ignored):
+	if pyinotify is not None:
+		return InotifyWatcher(root, ignored)
+	return PollingWatcher(root, ignored)
+
+def watch(root, build, ignored=None):
+	"""Runs build() once and then again after every change under root.
+
+	build() returns False when the build failed; watching carries on so the
+	next change can fix it. Whatever the build writes must be in ignored:
+	changes made while it runs are kept for the next build, so its own
+	writes would start another.
+	"""
+	root = realpath(root)
+	ignored = [join(root, d) for d in IGNORED_DIRS] + \
+			[realpath(i) for i in ignored or []]
+
+	# Watch from before the first build, so edits made during it count
+	watcher = make_watcher(root, ignored)
+	build()
+	mode = "inotify" if pyinotify is not None else "polling"
+	pe("watch", "{0} ({1})".format(root, mode))
+
+	while True:
+		changed = watcher.wait()
+		start = time()
+		ok = build()
+		pe("rebuilt", len(changed), time() - start, ok)
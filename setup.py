@@ -25,7 +25,10 @@ setup(
 		"termcolor==1.1.0",
 		"Jinja2==2.7.0",
 		"CoffeeScript==1.0.5",
+		"PyExecJS==1.5.1",
 #		"pyOpenSSL==0.13",
+#		"pysendfile==2.0.1",
+#		"brotli==1.0.9",
 	]
 )
 